@@ -0,0 +1,64 @@
+"""
+Benchmark accepting an invitation: the latency of a POST to the
+``invitation_accepted`` view, which creates and logs in the new user, and
+of the ``authenticate()`` call earlier versions of the view made before
+logging in, which loaded the user again and re-hashed the password::
+
+    python -m benchmarks.bench_accept --requests=50
+
+The accept latency of those versions was about the sum of the two. Pass
+``--hasher`` to measure with another password hasher than Django's
+default PBKDF2.
+
+"""
+
+from optparse import OptionParser
+
+from benchmarks import utils
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--requests', type='int', default=50,
+                      help='Number of invitations accepted.')
+    parser.add_option('--hasher', default=None,
+                      help='Dotted path of the password hasher to use.')
+    options, args = parser.parse_args()
+
+    overrides = {}
+    if options.hasher:
+        overrides['PASSWORD_HASHERS'] = (options.hasher,)
+    tmpdir = utils.setup(**overrides)
+    try:
+        from django.contrib.auth import authenticate
+        from django.core.urlresolvers import reverse
+        from django.test.client import Client
+
+        client = Client()
+        codes = utils.seed_invitations(utils.get_user(), 0, options.requests)
+        urls = iter([reverse('invitation_accepted', kwargs={'invitation_code': code})
+                     for code in codes])
+        usernames = iter('accepted%d' % n for n in xrange(options.requests))
+
+        def accept():
+            url = next(urls)
+            response = client.post(url, data={'username': next(usernames),
+                                              'password1': 'secret', 'password2': 'secret'})
+            utils.check_status(response, 302, url)
+            client.logout()
+        per_post = utils.timed(accept, options.requests)
+        utils.check_accepted(codes)
+
+        usernames = iter('accepted%d' % n for n in xrange(options.requests))
+        per_authenticate = utils.timed(
+            lambda: authenticate(username=next(usernames), password='secret'), options.requests)
+
+        print '%-28s %10.2f ms' % ('accept POST', per_post * 1e3)
+        print '%-28s %10.2f ms' % ('authenticate() (removed)', per_authenticate * 1e3)
+        print '%-28s %10.2f ms' % ('accept POST with it', (per_post + per_authenticate) * 1e3)
+    finally:
+        utils.teardown(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
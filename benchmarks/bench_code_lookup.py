@@ -0,0 +1,49 @@
+"""
+Benchmark the invitation code lookup made by the ``invitation_accepted``
+view, ``Invitation.objects.get(code=...)``, as the invitations table
+grows. With the unique index on ``code`` the cost should stay flat::
+
+    python -m benchmarks.bench_code_lookup --sizes=10000,100000,1000000,5000000
+
+"""
+
+import random
+from optparse import OptionParser
+
+from benchmarks import utils
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default='10000,100000,1000000',
+                      help='Comma separated table sizes to measure at.')
+    parser.add_option('--lookups', type='int', default=2000,
+                      help='Number of lookups timed at each size.')
+    options, args = parser.parse_args()
+
+    tmpdir = utils.setup()
+    try:
+        from django.db import connection
+        from invitation.models import Invitation
+
+        user = utils.get_user()
+        codes = []
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN SELECT id FROM %s WHERE code = %%s'
+                       % Invitation._meta.db_table, ['x'])
+        print 'Query plan: %s' % ' / '.join(str(row[-1]) for row in cursor.fetchall())
+
+        print '%12s %14s' % ('rows', 'usec/lookup')
+        for size in utils.parse_sizes(options.sizes):
+            codes.extend(utils.seed_invitations(user, len(codes), size))
+            sample = random.sample(codes, min(options.lookups, len(codes)))
+            lookups = iter(sample)
+            per_call = utils.timed(lambda: Invitation.objects.get(code=next(lookups)),
+                                   len(sample))
+            print '%12d %14.1f' % (size, per_call * 1e6)
+    finally:
+        utils.teardown(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Compare invitation code generators: the cost of generating a code, one at
+a time and in batches, and the size of a SQLite index over the codes::
+
+    python -m benchmarks.bench_codegen --codes=100000
+
+"""
+
+import sqlite3
+from optparse import OptionParser
+
+from benchmarks import utils
+
+
+class Inviter(object):
+    username = 'benchmark-user'
+
+
+def index_size(codes):
+    """
+    Return the number of bytes SQLite needs for an index over ``codes``.
+    """
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE invitation (code VARCHAR(40))')
+    db.executemany('INSERT INTO invitation VALUES (?)', ((code,) for code in codes))
+    page_size = db.execute('PRAGMA page_size').fetchone()[0]
+    before = db.execute('PRAGMA page_count').fetchone()[0]
+    db.execute('CREATE UNIQUE INDEX invitation_code ON invitation (code)')
+    after = db.execute('PRAGMA page_count').fetchone()[0]
+    db.close()
+    return (after - before) * page_size
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--codes', type='int', default=100000,
+                      help='Number of codes generated per scheme.')
+    options, args = parser.parse_args()
+
+    tmpdir = utils.setup()
+    try:
+        from invitation import codes
+
+        user = Inviter()
+        count = options.codes
+        print '%-14s %7s %14s %14s %12s' % ('generator', 'length', 'usec/code', 'usec/batched',
+                                             'index bytes')
+        for name in ('sha1_codes', 'random_codes'):
+            generator = getattr(codes, name)
+            single = utils.timed(lambda: generator(user, 1), count)
+            batched = utils.timed(lambda: generator(user, count), 1) / count
+            sample = generator(user, count)
+            print '%-14s %7d %14.2f %14.2f %12d' % (name, len(sample[0]), single * 1e6,
+                                                     batched * 1e6, index_size(sample))
+    finally:
+        utils.teardown(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
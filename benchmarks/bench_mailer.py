@@ -0,0 +1,88 @@
+"""
+Benchmark the per-message cost of rendering and sending invitation emails
+on the locmem email backend: rendering each email from scratch with
+``render_to_string`` (as ``Invitation.send()`` used to) against reusing
+one ``InvitationMailer``::
+
+    python -m benchmarks.bench_mailer --invitations=10000
+
+"""
+
+import datetime
+import time
+from optparse import OptionParser
+
+from benchmarks import utils
+
+
+def render_each(invitations):
+    """
+    Render every email on its own, fetching the site and loading the
+    templates each time.
+    """
+    from django.conf import settings
+    from django.contrib.sites.models import Site
+    from django.template.loader import render_to_string
+
+    for invitation in invitations:
+        current_site = Site.objects.get_current()
+        subject = render_to_string('invitation/invitation_email_subject.txt',
+                                   {'invitation': invitation, 'site': current_site})
+        subject = ''.join(subject.splitlines())
+        render_to_string('invitation/invitation_email.txt',
+                         {'invitation': invitation,
+                          'expiration_days': settings.ACCOUNT_INVITATION_DAYS,
+                          'site': current_site})
+
+
+def render_mailer(invitations):
+    from invitation.mailer import InvitationMailer
+
+    mailer = InvitationMailer()
+    for invitation in invitations:
+        mailer.render(invitation)
+
+
+def send_each(invitations):
+    for invitation in invitations:
+        invitation.send(queue=False)
+
+
+def send_mailer(invitations):
+    from invitation.mailer import InvitationMailer
+
+    InvitationMailer().send(invitations)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--invitations', type='int', default=10000,
+                      help='Number of invitation emails rendered per run.')
+    options, args = parser.parse_args()
+
+    tmpdir = utils.setup()
+    try:
+        from django.core import mail
+        from invitation.codes import random_codes
+        from invitation.models import Invitation
+
+        user = utils.get_user()
+        now = datetime.datetime.now()
+        invitations = [Invitation(from_user=user, email='user%d@example.com' % n, code=code,
+                                  date_invited=now, expiration_date=now)
+                       for n, code in enumerate(random_codes(user, options.invitations))]
+
+        print '%-16s %14s' % ('method', 'usec/message')
+        for name, func in (('render_each', render_each), ('render_mailer', render_mailer),
+                           ('send_each', send_each), ('send_mailer', send_mailer)):
+            mail.outbox = []
+            started = time.time()
+            func(invitations)
+            elapsed = time.time() - started
+            print '%-16s %14.1f' % (name, elapsed / len(invitations) * 1e6)
+    finally:
+        utils.teardown(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
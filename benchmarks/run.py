@@ -0,0 +1,215 @@
+"""
+Benchmark suite for the invitation lifecycle.
+
+Measures, against the example project on a temporary SQLite database:
+
+* ``create_invitation`` throughput;
+* latency of the accept page (GET and POST) with the invitations table
+  seeded to each of ``--sizes`` rows;
+* ``InvitationForm`` validation cost;
+* the purge rate of ``delete_expired_invitations``;
+* email render and send rate on the locmem backend.
+
+Results are printed and can be saved as JSON with ``--output``. Pass a
+previously saved file to ``--compare`` to report the change of every
+metric against it; the run exits with status 1 if any metric regressed by
+more than ``--threshold``::
+
+    python -m benchmarks.run --output=baseline.json
+    python -m benchmarks.run --compare=baseline.json --threshold=0.2
+
+"""
+
+import datetime
+import json
+import platform
+import sys
+import time
+from optparse import OptionParser
+
+from benchmarks import utils
+
+HIGHER = 'higher'
+LOWER = 'lower'
+
+
+class Results(object):
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, name, value, unit, better):
+        self.metrics[name] = {'value': value, 'unit': unit, 'better': better}
+        print '%-32s %14.2f %s' % (name, value, unit)
+
+
+def bench_create(options, user, results):
+    from invitation.models import Invitation
+
+    count = options.operations
+    started = time.time()
+    for n in xrange(count):
+        Invitation.objects.create_invitation(user, 'create%d@example.com' % n)
+    results.add('create_invitation', count / (time.time() - started), 'ops/s', HIGHER)
+
+
+def bench_form(options, user, results):
+    from invitation.forms import InvitationForm
+
+    count = options.operations
+    per_call = utils.timed(lambda: InvitationForm(data={'email': 'new@example.com'}).is_valid(),
+                           count)
+    results.add('form_validation', per_call * 1e6, 'usec', LOWER)
+
+
+def bench_accept(options, user, results):
+    from django.core.urlresolvers import reverse
+    from django.test.client import Client
+
+    client = Client()
+    codes = []
+    for size in utils.parse_sizes(options.sizes):
+        codes.extend(utils.seed_invitations(user, len(codes), size))
+        sample = codes[-options.requests * 2:]
+        urls = [reverse('invitation_accepted', kwargs={'invitation_code': code})
+                for code in sample]
+        get_urls = iter(urls[:options.requests])
+
+        def show():
+            url = next(get_urls)
+            utils.check_status(client.get(url), 200, url)
+        per_get = utils.timed(show, options.requests)
+        results.add('accept_get_%d' % size, per_get * 1e3, 'ms', LOWER)
+
+        post_urls = iter(urls[options.requests:])
+        usernames = iter('accepted%d_%d' % (size, n) for n in xrange(options.requests))
+
+        def accept():
+            url = next(post_urls)
+            response = client.post(url, data={'username': next(usernames),
+                                               'password1': 'secret', 'password2': 'secret'})
+            utils.check_status(response, 302, url)
+            client.logout()
+        per_post = utils.timed(accept, options.requests)
+        utils.check_accepted(sample[options.requests:])
+        results.add('accept_post_%d' % size, per_post * 1e3, 'ms', LOWER)
+
+
+def bench_cleanup(options, user, results):
+    from invitation.models import Invitation
+
+    count = options.purge
+    utils.seed_invitations(user, 0, count, expired=True)
+    started = time.time()
+    deleted = Invitation.objects.delete_expired_invitations()
+    results.add('cleanup_purge', deleted / (time.time() - started), 'rows/s', HIGHER)
+
+
+def bench_email(options, user, results):
+    from django.core import mail
+    from invitation.codes import random_codes
+    from invitation.mailer import InvitationMailer
+    from invitation.models import Invitation
+
+    now = datetime.datetime.now()
+    invitations = [Invitation(from_user=user, email='mail%d@example.com' % n, code=code,
+                              date_invited=now, expiration_date=now)
+                   for n, code in enumerate(random_codes(user, options.operations))]
+    mailer = InvitationMailer()
+    started = time.time()
+    for invitation in invitations:
+        mailer.render(invitation)
+    results.add('email_render', len(invitations) / (time.time() - started), 'msgs/s', HIGHER)
+
+    mail.outbox = []
+    started = time.time()
+    mailer.send(invitations)
+    results.add('email_send', len(invitations) / (time.time() - started), 'msgs/s', HIGHER)
+
+
+BENCHMARKS = (
+    ('create', bench_create),
+    ('form', bench_form),
+    ('accept', bench_accept),
+    ('cleanup', bench_cleanup),
+    ('email', bench_email),
+)
+
+
+def compare(baseline, current, threshold):
+    """
+    Print the change of each metric from ``baseline`` to ``current`` and
+    return the names of those which got worse by more than ``threshold``
+    (a fraction).
+    """
+    regressions = []
+    print
+    print '%-32s %14s %14s %9s' % ('metric', 'baseline', 'current', 'change')
+    for name in sorted(current):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['value'], current[name]['value']
+        change = (new - old) / old if old else 0.0
+        worse = -change if current[name]['better'] == HIGHER else change
+        flag = ''
+        if worse > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print '%-32s %14.2f %14.2f %+8.1f%%%s' % (name, old, new, change * 100, flag)
+    return regressions
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--only', default=','.join(name for name, func in BENCHMARKS),
+                      help='Comma separated benchmarks to run.')
+    parser.add_option('--sizes', default='10000,100000,1000000',
+                      help='Table sizes to measure accept latency at.')
+    parser.add_option('--operations', type='int', default=1000,
+                      help='Operations timed by the create, form and email benchmarks.')
+    parser.add_option('--requests', type='int', default=50,
+                      help='Requests timed per table size by the accept benchmark.')
+    parser.add_option('--purge', type='int', default=100000,
+                      help='Expired invitations purged by the cleanup benchmark.')
+    parser.add_option('--output', help='Write the results to this JSON file.')
+    parser.add_option('--compare', help='Compare the results against this JSON file.')
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='Relative change counted as a regression (default 0.1).')
+    options, args = parser.parse_args()
+
+    selected = options.only.split(',')
+    results = Results()
+    tmpdir = utils.setup()
+    try:
+        for name, func in BENCHMARKS:
+            if name in selected:
+                func(options, utils.get_user(), results)
+                # Start each benchmark from an empty database.
+                utils.reset()
+    finally:
+        utils.teardown(tmpdir)
+
+    import django
+    report = {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'options': options.__dict__,
+        },
+        'results': results.metrics,
+    }
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as baseline:
+            regressions = compare(json.load(baseline)['results'], results.metrics,
+                                  options.threshold)
+        if regressions:
+            print '\n%d regression(s): %s' % (len(regressions), ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
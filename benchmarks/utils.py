@@ -0,0 +1,150 @@
+"""
+Shared setup for the invitation benchmarks.
+
+Benchmarks run the example ``invitation_project`` -- its settings,
+templates and URLs -- against a throwaway SQLite database in a temporary
+directory, so they can be run from a plain checkout::
+
+    python -m benchmarks.run
+
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLE_PROJECT = os.path.join(ROOT, 'examples', 'invitation_project')
+
+
+def setup(**overrides):
+    """
+    Configure Django from the example project's settings, with the
+    database moved to a temporary directory and email going to the
+    locmem backend, and create the database schema.
+
+    Returns the temporary directory holding the database, which should be
+    passed to ``teardown()`` once the benchmark is done.
+    """
+    for path in (ROOT, EXAMPLE_PROJECT):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    tmpdir = tempfile.mkdtemp(prefix='invitation-bench-')
+
+    from django.conf import settings
+    from django.utils.importlib import import_module
+    example = import_module('settings')
+    options = dict((name, getattr(example, name)) for name in dir(example) if name.isupper())
+    options.update({
+        'DEBUG': False,
+        'TEMPLATE_DEBUG': False,
+        # Without DEBUG, the test client's host must be allowed explicitly.
+        'ALLOWED_HOSTS': ['testserver'],
+        'DATABASES': {
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(tmpdir, 'bench.sqlite'),
+            },
+        },
+        'EMAIL_BACKEND': 'django.core.mail.backends.locmem.EmailBackend',
+    })
+    options.update(overrides)
+    settings.configure(**options)
+
+    from django.core.management import call_command
+    call_command('syncdb', interactive=False, verbosity=0)
+    return tmpdir
+
+
+def reset():
+    """
+    Empty the database and the cache between benchmarks.
+    """
+    from django.core.cache import cache
+    from django.core.management import call_command
+    call_command('flush', interactive=False, verbosity=0)
+    cache.clear()
+
+
+def teardown(tmpdir):
+    from django.db import connection
+    connection.close()
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def get_user(username='bench'):
+    from django.contrib.auth.models import User
+    user, created = User.objects.get_or_create(username=username,
+                                               defaults={'email': '%s@example.com' % username})
+    return user
+
+
+def seed_invitations(user, start, stop, expired=False, chunk=50000):
+    """
+    Insert invitations number ``start`` to ``stop`` for ``user`` with raw
+    ``executemany`` calls, which is far quicker than the ORM for seeding
+    millions of rows. Returns the codes of the inserted rows.
+    """
+    import datetime
+    from django.db import connection, transaction
+    from invitation.models import Invitation
+
+    table = Invitation._meta.db_table
+    sql = ('INSERT INTO %s (code, date_invited, expiration_date, used, from_user_id, email, '
+           'delivery_status) VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s)' % table)
+    now = datetime.datetime.now()
+    if expired:
+        expires = now - datetime.timedelta(1)
+        prefix = 'expired'
+    else:
+        expires = now + datetime.timedelta(30)
+        prefix = 'seed'
+    codes = []
+    cursor = connection.cursor()
+    for offset in xrange(start, stop, chunk):
+        rows = []
+        for n in xrange(offset, min(offset + chunk, stop)):
+            code = '%040x' % random.getrandbits(160)
+            codes.append(code)
+            rows.append((code, now, expires, False, user.pk, '%s%d@example.com' % (prefix, n), ''))
+        cursor.executemany(sql, rows)
+        transaction.commit_unless_managed()
+    return codes
+
+
+def check_status(response, status, url):
+    """
+    Fail the benchmark if ``response`` does not have the expected
+    ``status``, rather than timing an error page.
+    """
+    if response.status_code != status:
+        raise RuntimeError("%s answered %d, expected %d"
+                           % (url, response.status_code, status))
+
+
+def check_accepted(codes):
+    """
+    Fail the benchmark unless every invitation in ``codes`` has been used.
+    """
+    from invitation.models import Invitation
+    used = Invitation.objects.filter(code__in=codes, used=True).count()
+    if used != len(codes):
+        raise RuntimeError("Only %d of %d invitations were accepted" % (used, len(codes)))
+
+
+def timed(func, repeat):
+    """
+    Call ``func`` ``repeat`` times and return the mean wall-clock seconds
+    per call.
+    """
+    started = time.time()
+    for i in xrange(repeat):
+        func()
+    return (time.time() - started) / repeat
+
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(',') if size]
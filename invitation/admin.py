@@ -1,11 +1,66 @@
+import datetime
+
+from django.conf import settings
 from django.contrib import admin
-from invitation.models import Invitation
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _, ungettext
+
+from invitation.models import Invitation, STATUS_EXPIRED
+
+
+class ExpiredListFilter(admin.SimpleListFilter):
+    title = _('expired')
+    parameter_name = 'expired'
+
+    def lookups(self, request, model_admin):
+        return (('1', _('Yes')), ('0', _('No')))
+
+    def queryset(self, request, queryset):
+        if self.value() == '1':
+            return queryset.expired()
+        if self.value() == '0':
+            return queryset.filter(Q(used=True) | Q(expiration_date__gte=timezone.now()))
+
 
 class InvitationAdmin(admin.ModelAdmin):
     list_display = ('__unicode__', 'from_user', 'email', 'date_invited', 'used', 'invitation_expired')
+    list_select_related = True
+    list_filter = ('used', ExpiredListFilter, 'delivery_status')
+    date_hierarchy = 'date_invited'
+    filter_horizontal = ('groups',)
+    actions = ['resend_invitations', 'extend_invitations', 'expire_invitations']
+
+    def queryset(self, request):
+        # Work out expiry in the database rather than per row in Python.
+        return super(InvitationAdmin, self).queryset(request).annotate_status()
 
     def invitation_expired(self, obj):
+        if hasattr(obj, 'status'):
+            return obj.status == STATUS_EXPIRED
         return obj.expired()
     invitation_expired.boolean = True
+    invitation_expired.admin_order_field = 'expiration_date'
+
+    def resend_invitations(self, request, queryset):
+        count = Invitation.objects.send_invitations(queryset.filter(used=False))
+        self.message_user(request, ungettext("Resent %d invitation.",
+                                             "Resent %d invitations.", count) % count)
+    resend_invitations.short_description = _("Resend selected invitations")
+
+    def extend_invitations(self, request, queryset):
+        expiration_date = timezone.now() + datetime.timedelta(settings.ACCOUNT_INVITATION_DAYS)
+        count = queryset.filter(used=False).update(expiration_date=expiration_date)
+        Invitation.objects.invalidate_lookups()
+        self.message_user(request, ungettext("Extended %d invitation.",
+                                             "Extended %d invitations.", count) % count)
+    extend_invitations.short_description = _("Extend selected invitations")
+
+    def expire_invitations(self, request, queryset):
+        count = queryset.filter(used=False).update(expiration_date=timezone.now())
+        Invitation.objects.invalidate_lookups()
+        self.message_user(request, ungettext("Expired %d invitation.",
+                                             "Expired %d invitations.", count) % count)
+    expire_invitations.short_description = _("Expire selected invitations")
 
 admin.site.register(Invitation, InvitationAdmin)
@@ -0,0 +1,168 @@
+"""
+A small, bounded pool of worker threads for work which should not hold up
+a response, such as talking to the SMTP server.
+
+Set ``INVITATION_SEND_IN_BACKGROUND = True`` to have ``Invitation.send()``
+hand the email to the pool, so that the ``invite`` view answers without
+waiting for the mail server. The pool runs ``INVITATION_BACKGROUND_WORKERS``
+threads (4 by default) and queues at most
+``INVITATION_BACKGROUND_QUEUE_SIZE`` jobs (100 by default); once the queue
+is full, further jobs run in the submitting thread, so a slow mail server
+slows requests down rather than piling up unsent email in memory.
+
+Jobs run outside of any request and should not rely on its state; each
+worker closes its database connections after every job. A job reading rows
+written by the request must not start before they are committed: add
+``invitation.background.DeferredJobsMiddleware`` to ``MIDDLEWARE_CLASSES``,
+above ``django.middleware.transaction.TransactionMiddleware`` if that is
+used, and jobs submitted with ``defer()`` while a transaction is managed
+are held until the response, after the commit, and dropped if the view
+raises. The queue is only
+kept in memory, so jobs still in it when the process exits are lost; an
+invitation email which fails to send is put in the outbox instead.
+
+"""
+
+import logging
+import Queue
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+logger = logging.getLogger('invitation.background')
+
+_pool = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+
+class Job(object):
+    """
+    A call submitted to a ``WorkerPool``, which can be waited for.
+    """
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.exception = None
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            self.exception = e
+            logger.exception("Background job %r failed", self.func)
+        finally:
+            self._done.set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the job to finish; returns ``False`` on timeout.
+        """
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def get(self, timeout=None):
+        """
+        Wait for the job and return its result, or raise its exception.
+        """
+        if not self.wait(timeout):
+            raise RuntimeError("Background job %r did not finish in time" % self.func)
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+
+class WorkerPool(object):
+    def __init__(self, workers=4, queue_size=100):
+        self.size = workers
+        self.queue = Queue.Queue(queue_size)
+        self.workers = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self.workers) < self.size:
+                worker = threading.Thread(target=self._work, name='invitation-background')
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                job.run()
+            finally:
+                for connection in connections.all():
+                    connection.close()
+                self.queue.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Run ``func(*args, **kwargs)`` in a worker thread, or right away in
+        this one if the queue is full. Returns the ``Job``.
+        """
+        job = Job(func, args, kwargs)
+        self._start()
+        try:
+            self.queue.put_nowait(job)
+        except Queue.Full:
+            job.run()
+        return job
+
+    def join(self):
+        """
+        Wait until every submitted job has finished.
+        """
+        self.queue.join()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool(getattr(settings, 'INVITATION_BACKGROUND_WORKERS', 4),
+                               getattr(settings, 'INVITATION_BACKGROUND_QUEUE_SIZE', 100))
+        return _pool
+
+
+def submit(func, *args, **kwargs):
+    return get_pool().submit(func, *args, **kwargs)
+
+
+def defer(func, *args, **kwargs):
+    """
+    Submit ``func(*args, **kwargs)`` once the current transaction on the
+    database ``using`` (a keyword argument, ``'default'`` if not given) has
+    committed. Jobs are only held back in requests handled by
+    ``DeferredJobsMiddleware`` while the transaction is managed; otherwise,
+    e.g. in autocommit mode, they are submitted at once.
+    """
+    using = kwargs.pop('using', None) or DEFAULT_DB_ALIAS
+    deferred = getattr(_local, 'deferred', None)
+    if deferred is None or not transaction.is_managed(using=using):
+        submit(func, *args, **kwargs)
+    else:
+        deferred.append((func, args, kwargs))
+
+
+class DeferredJobsMiddleware(object):
+    """
+    Holds the jobs passed to ``defer()`` during a request until its
+    response, and drops them if the view raises.
+    """
+    def process_request(self, request):
+        _local.deferred = []
+
+    def process_exception(self, request, exception):
+        _local.deferred = None
+
+    def process_response(self, request, response):
+        deferred, _local.deferred = getattr(_local, 'deferred', None), None
+        for func, args, kwargs in deferred or ():
+            submit(func, *args, **kwargs)
+        return response
@@ -0,0 +1,64 @@
+"""
+Invitation code generators.
+
+A code generator is a callable taking the inviting ``User`` and a number
+of codes, and returning a list of that many new codes. The generator used
+by ``InvitationManager`` is chosen with the ``INVITATION_CODE_GENERATOR``
+setting, a dotted path which defaults to ``invitation.codes.random_codes``.
+
+Codes end up in invitation URLs, so they must only contain characters
+matched by ``[\w-]``.
+
+"""
+
+import base64
+import datetime
+import hashlib
+import os
+import random
+
+from django.conf import settings
+
+from invitation.utils import import_from_setting
+
+DEFAULT_CODE_GENERATOR = 'invitation.codes.random_codes'
+
+
+def random_codes(user, count):
+    """
+    Generate URL-safe codes from ``os.urandom``.
+
+    Each code encodes ``INVITATION_CODE_BYTES`` (15 by default, i.e. 120
+    bits) of randomness as unpadded URL-safe base64, giving 20 character
+    codes. The randomness for the whole batch is read in a single call.
+    """
+    size = getattr(settings, 'INVITATION_CODE_BYTES', 15)
+    data = os.urandom(size * count)
+    return [base64.urlsafe_b64encode(data[i:i + size]).rstrip('=')
+            for i in xrange(0, size * count, size)]
+
+
+def sha1_codes(user, count):
+    """
+    Generate 40 character SHA1 hex digests from the inviting user's
+    username, the current time and a random salt, as earlier versions of
+    django-invitation did.
+    """
+    codes = []
+    for i in xrange(count):
+        salt = hashlib.sha1(str(random.random())).hexdigest()[:5]
+        codes.append(hashlib.sha1("%s%s%s" % (datetime.datetime.now(), salt,
+                                              user.username)).hexdigest())
+    return codes
+
+
+def get_code_generator():
+    """
+    Return the code generator named by ``INVITATION_CODE_GENERATOR``.
+    """
+    path = getattr(settings, 'INVITATION_CODE_GENERATOR', DEFAULT_CODE_GENERATOR)
+    return import_from_setting(path, 'invitation code generator')
+
+
+def generate_codes(user, count):
+    return get_code_generator()(user, count)
@@ -0,0 +1,126 @@
+"""
+Streaming export and aggregated statistics of invitations, shared by the
+``exportinvitations`` command and the ``export_invitations`` view.
+
+Exports read the table in primary key order, ``chunk_size`` rows per
+query, with a ``values()`` projection, so memory use does not grow with
+the size of the table. Statistics are computed with one ``GROUP BY``
+query per dimension.
+
+"""
+
+import csv
+import datetime
+import json
+from cStringIO import StringIO
+
+from django.db import connection
+from django.db.models import Count
+
+from invitation.models import Invitation, STATUS_PENDING, STATUS_EXPIRED, STATUS_USED
+
+EXPORT_FIELDS = ('id', 'email', 'from_user__username', 'date_invited', 'expiration_date',
+                 'delivery_status', 'status')
+
+FORMATS = ('csv', 'jsonl')
+STATS_DIMENSIONS = ('status', 'inviter', 'day')
+STATUSES = (STATUS_PENDING, STATUS_EXPIRED, STATUS_USED)
+
+
+def iter_invitations(queryset=None, chunk_size=2000):
+    """
+    Yield a dictionary of ``EXPORT_FIELDS`` for each invitation in
+    ``queryset`` (by default, all of them).
+    """
+    if queryset is None:
+        queryset = Invitation.objects.all()
+    queryset = queryset.annotate_status().order_by('pk').values(*EXPORT_FIELDS)
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = 0
+        for row in chunk[:chunk_size].iterator():
+            rows += 1
+            last_pk = row['id']
+            yield row
+        if rows < chunk_size:
+            return
+
+
+def _format_value(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def csv_lines(rows, fields=EXPORT_FIELDS):
+    """
+    Yield ``rows`` as CSV lines, starting with a header line.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(fields)
+    yield buf.getvalue()
+    for row in rows:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow([_format_value(row[field]) for field in fields])
+        yield buf.getvalue()
+
+
+def jsonl_lines(rows):
+    """
+    Yield ``rows`` as JSON lines.
+    """
+    for row in rows:
+        yield json.dumps(dict((key, _format_value(value)) for key, value in row.items()),
+                         sort_keys=True) + '\n'
+
+
+def stats_fields(dimension):
+    """
+    Return the keys of the dictionaries ``invitation_stats(dimension)``
+    returns, in output order.
+    """
+    if dimension == 'status':
+        return ('status', 'count')
+    return (dimension, 'sent') + STATUSES
+
+
+def invitation_stats(dimension, queryset=None):
+    """
+    Count invitations by ``dimension``, one of ``STATS_DIMENSIONS``, with
+    a single ``GROUP BY`` query.
+
+    For ``'status'`` returns a list of ``{'status': ..., 'count': ...}``
+    dictionaries. For ``'inviter'`` and ``'day'`` returns one dictionary
+    per inviter's username or day invited, holding the number of
+    invitations ``sent`` and how many of those are pending, expired and
+    used.
+    """
+    if queryset is None:
+        queryset = Invitation.objects.all()
+    queryset = queryset.annotate_status().order_by()
+    if dimension == 'status':
+        return list(queryset.values('status').annotate(count=Count('pk')).order_by('status'))
+    if dimension == 'inviter':
+        key = 'from_user__username'
+    elif dimension == 'day':
+        key = 'day'
+        column = '%s.%s' % (connection.ops.quote_name(Invitation._meta.db_table),
+                            connection.ops.quote_name('date_invited'))
+        queryset = queryset.extra(select={'day': connection.ops.date_trunc_sql('day', column)})
+    else:
+        raise ValueError("Unknown dimension %r, expected one of %s"
+                         % (dimension, ', '.join(STATS_DIMENSIONS)))
+
+    stats = {}
+    for row in queryset.values(key, 'status').annotate(count=Count('pk')):
+        if row[key] not in stats:
+            stats[row[key]] = dict([(dimension, row[key]), ('sent', 0)] +
+                                   [(status, 0) for status in STATUSES])
+        stats[row[key]][row['status']] += row['count']
+        stats[row[key]]['sent'] += row['count']
+    return [stats[value] for value in sorted(stats)]
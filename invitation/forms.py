@@ -1,5 +1,4 @@
 from django import forms
-from django.contrib.auth.models import User, Group
 from django.utils.translation import ugettext_lazy as _
 
 from invitation.models import Invitation
@@ -16,8 +15,9 @@ class InvitationForm(forms.Form):
 
     def clean_email(self):
         email = self.cleaned_data["email"].strip().lower()
-        if Invitation.objects.filter(email__iexact=email).count():
+        invited, registered = Invitation.objects.unavailable_emails([email])
+        if invited:
             raise forms.ValidationError(_("An invitation has already been sent to that address."))
-        elif User.objects.filter(email__iexact=email).count():
+        elif registered:
             raise forms.ValidationError(_("A user with that email address has already registered."))
         return email
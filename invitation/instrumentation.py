@@ -0,0 +1,174 @@
+"""
+Opt-in timing and query counting for the invitation views.
+
+Set ``INVITATION_INSTRUMENTATION = True`` to have each request to the
+``invite`` and ``invitation_accepted`` views timed, stage by stage (quota
+check, form validation, code generation, email rendering, SMTP, account
+creation, login...), and its database queries counted. The resulting
+``Measurement`` is handed to each sink named in
+``INVITATION_INSTRUMENTATION_SINKS`` (by default, just
+``invitation.instrumentation.LoggingSink``).
+
+``INVITATION_QUERY_BUDGETS`` maps view names to the number of queries a
+request may make; measurements over budget are flagged, and logged as
+warnings by ``LoggingSink``.
+
+"""
+
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+
+from invitation.utils import import_from_setting
+
+logger = logging.getLogger('invitation.instrumentation')
+
+_local = threading.local()
+_sinks = {}
+
+
+class Measurement(object):
+    """
+    The stage timings and query count of one request to a view.
+    """
+    def __init__(self, view, budget=None):
+        self.view = view
+        self.budget = budget
+        self.stages = []
+        self.queries = 0
+        self.duration = 0.0
+
+    @property
+    def over_budget(self):
+        return self.budget is not None and self.queries > self.budget
+
+    def stage_durations(self):
+        durations = {}
+        for name, duration in self.stages:
+            durations[name] = durations.get(name, 0.0) + duration
+        return durations
+
+
+class LoggingSink(object):
+    """
+    Logs each measurement to the ``invitation.instrumentation`` logger.
+    """
+    def record(self, measurement):
+        stages = ', '.join('%s=%.1fms' % (name, duration * 1000)
+                           for name, duration in measurement.stages)
+        message = '%s: %.1fms, %d queries (%s)' % (measurement.view, measurement.duration * 1000,
+                                                   measurement.queries, stages)
+        if measurement.over_budget:
+            logger.warning('%s, over the budget of %d queries' % (message, measurement.budget))
+        else:
+            logger.info(message)
+
+
+class StatsdSink(object):
+    """
+    Sends each measurement as statsd timers and a gauge, in one UDP
+    datagram, to ``INVITATION_STATSD_HOST``:``INVITATION_STATSD_PORT``
+    (``127.0.0.1:8125`` by default), prefixed with
+    ``INVITATION_STATSD_PREFIX`` (``invitation``).
+    """
+    def __init__(self):
+        self.address = (getattr(settings, 'INVITATION_STATSD_HOST', '127.0.0.1'),
+                        getattr(settings, 'INVITATION_STATSD_PORT', 8125))
+        self.prefix = getattr(settings, 'INVITATION_STATSD_PREFIX', 'invitation')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, measurement):
+        prefix = '%s.%s' % (self.prefix, measurement.view)
+        lines = ['%s.time:%d|ms' % (prefix, measurement.duration * 1000),
+                 '%s.queries:%d|g' % (prefix, measurement.queries)]
+        for name, duration in sorted(measurement.stage_durations().items()):
+            lines.append('%s.%s:%d|ms' % (prefix, name, duration * 1000))
+        try:
+            self.socket.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            # Metrics must never break a request.
+            pass
+
+
+class MemorySink(object):
+    """
+    Keeps every measurement in ``MemorySink.measurements``, for tests.
+    """
+    measurements = []
+
+    def record(self, measurement):
+        self.measurements.append(measurement)
+
+    @classmethod
+    def clear(cls):
+        del cls.measurements[:]
+
+
+def get_sinks():
+    paths = tuple(getattr(settings, 'INVITATION_INSTRUMENTATION_SINKS',
+                          ('invitation.instrumentation.LoggingSink',)))
+    if paths not in _sinks:
+        _sinks[paths] = [import_from_setting(path, 'instrumentation sink')()
+                         for path in paths]
+    return _sinks[paths]
+
+
+@contextmanager
+def stage(name):
+    """
+    Time the enclosed block as stage ``name`` of the request being
+    measured. Does nothing when no request is being measured.
+    """
+    measurement = getattr(_local, 'measurement', None)
+    if measurement is None:
+        yield
+        return
+    started = time.time()
+    try:
+        yield
+    finally:
+        measurement.stages.append((name, time.time() - started))
+
+
+def instrumented(view_name):
+    """
+    Decorator measuring each request to a view, if
+    ``INVITATION_INSTRUMENTATION`` is enabled.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not getattr(settings, 'INVITATION_INSTRUMENTATION', False) \
+                    or getattr(_local, 'measurement', None) is not None:
+                return view(request, *args, **kwargs)
+
+            budget = getattr(settings, 'INVITATION_QUERY_BUDGETS', {}).get(view_name)
+            measurement = _local.measurement = Measurement(view_name, budget)
+            # Queries are counted on every connection, not only the default
+            # one, so reads routed to a replica count against the budget.
+            logs = [(conn, conn.use_debug_cursor, len(conn.queries))
+                    for conn in connections.all()]
+            for conn, use_debug_cursor, queries_before in logs:
+                conn.use_debug_cursor = True
+            started = time.time()
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                measurement.duration = time.time() - started
+                for conn, use_debug_cursor, queries_before in logs:
+                    measurement.queries += len(conn.queries) - queries_before
+                    conn.use_debug_cursor = use_debug_cursor
+                    if not (use_debug_cursor or settings.DEBUG):
+                        # Don't let the query log grow outside DEBUG.
+                        del conn.queries[queries_before:]
+                _local.measurement = None
+                for sink in get_sinks():
+                    sink.record(measurement)
+        return wrapper
+    return decorator
@@ -0,0 +1,84 @@
+"""
+Rendering and sending of invitation emails.
+
+"""
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.mail import EmailMessage, get_connection
+from django.template import Context
+from django.template.loader import get_template
+
+from invitation.instrumentation import stage
+
+DEFAULT_SUBJECT_TEMPLATE = 'invitation/invitation_email_subject.txt'
+DEFAULT_MESSAGE_TEMPLATE = 'invitation/invitation_email.txt'
+
+
+class InvitationMailer(object):
+    """
+    Renders and sends invitation emails.
+
+    The current ``Site`` is fetched and the templates are compiled once,
+    when they are first needed, and then reused for every invitation the
+    mailer renders. Templates can be given by name or as compiled
+    ``Template`` objects, both here and per call to ``render()``.
+    """
+    def __init__(self, from_email=None, subject_template=DEFAULT_SUBJECT_TEMPLATE,
+                 message_template=DEFAULT_MESSAGE_TEMPLATE, site=None):
+        self.from_email = from_email or settings.DEFAULT_FROM_EMAIL
+        self.subject_template = subject_template
+        self.message_template = message_template
+        self._site = site
+        self._templates = {}
+
+    @property
+    def site(self):
+        if self._site is None:
+            self._site = Site.objects.get_current()
+        return self._site
+
+    def get_template(self, template):
+        if not isinstance(template, basestring):
+            return template
+        if template not in self._templates:
+            self._templates[template] = get_template(template)
+        return self._templates[template]
+
+    def render(self, invitation, subject_template=None, message_template=None):
+        """
+        Render the email for ``invitation`` and return it as a
+        ``(subject, message, from_email, recipient_list)`` tuple, as
+        expected by ``send_mass_mail``.
+        """
+        context = {'invitation': invitation,
+                   'expiration_days': settings.ACCOUNT_INVITATION_DAYS,
+                   'site': self.site}
+        subject = self.get_template(subject_template or self.subject_template) \
+                      .render(Context(context))
+        # Email subject *must not* contain newlines
+        subject = ''.join(subject.splitlines())
+        message = self.get_template(message_template or self.message_template) \
+                      .render(Context(context))
+        return (subject, message, self.from_email, [invitation.email])
+
+    def message(self, invitation, subject_template=None, message_template=None,
+                connection=None):
+        """
+        Return the email for ``invitation`` as an ``EmailMessage``.
+        """
+        subject, message, from_email, recipients = self.render(invitation, subject_template,
+                                                               message_template)
+        return EmailMessage(subject, message, from_email, recipients, connection=connection)
+
+    def send(self, invitations, connection=None, fail_silently=False):
+        """
+        Send the emails for ``invitations`` over a single connection and
+        return the number sent.
+        """
+        connection = connection or get_connection(fail_silently=fail_silently)
+        with stage('render_email'):
+            messages = [self.message(invitation, connection=connection)
+                        for invitation in invitations]
+        with stage('smtp'):
+            return connection.send_messages(messages)
@@ -0,0 +1,99 @@
+"""
+A management command which invites a list of email addresses in bulk,
+on behalf of an existing user.
+
+Addresses are read from the first column of a CSV file, or from standard
+input when no file (or ``-``) is given, and are streamed through
+``Invitation.objects.iter_invitations_bulk()``, which writes them one batch
+at a time, so arbitrarily long lists can be invited without holding them in
+memory. A first row which holds no address, such as ``email,name``, is
+taken for a header and skipped.
+
+"""
+
+import csv
+import sys
+import time
+from optparse import make_option
+
+from django.contrib.auth.models import Group, User
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand, CommandError
+
+from invitation.mailer import InvitationMailer
+from invitation.models import Invitation
+
+
+class Command(BaseCommand):
+    args = '<username> [file]'
+    help = "Invite every email address in a CSV file (or stdin) on behalf of a user"
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+                    help='Number of addresses written and mailed per batch.'),
+        make_option('--no-send', dest='send', action='store_false', default=True,
+                    help='Create the invitations without sending any email.'),
+        make_option('--group', dest='groups', action='append', default=[],
+                    help='Name of a group the invited users join; may be repeated.'),
+    )
+
+    def handle(self, *args, **options):
+        if not args or len(args) > 2:
+            raise CommandError("Usage: bulkinvite %s" % self.args)
+        try:
+            user = User.objects.get(username=args[0])
+        except User.DoesNotExist:
+            raise CommandError("User '%s' does not exist" % args[0])
+
+        groups = list(Group.objects.filter(name__in=options['groups']))
+        missing = set(options['groups']) - set(group.name for group in groups)
+        if missing:
+            raise CommandError("Group '%s' does not exist" % sorted(missing)[0])
+
+        if len(args) == 2 and args[1] != '-':
+            try:
+                source = open(args[1], 'rb')
+            except IOError as e:
+                raise CommandError("Cannot open '%s': %s" % (args[1], e))
+        else:
+            source = sys.stdin
+
+        verbose = int(options['verbosity']) > 0
+        totals = {}
+        processed = 0
+        # Keep a single mail connection open, and the templates compiled,
+        # across every batch.
+        connection = None
+        mailer = InvitationMailer()
+        if options['send']:
+            connection = get_connection()
+            connection.open()
+        started = time.time()
+        try:
+            results = Invitation.objects.iter_invitations_bulk(
+                user, self._read_emails(source), batch_size=options['batch_size'],
+                send=options['send'], connection=connection, mailer=mailer, groups=groups)
+            for email, result in results:
+                processed += 1
+                totals[result] = totals.get(result, 0) + 1
+                if verbose:
+                    self.stdout.write("%s\t%s\n" % (email, result))
+        finally:
+            if connection is not None:
+                connection.close()
+            if source is not sys.stdin:
+                source.close()
+
+        elapsed = time.time() - started
+        rate = processed / elapsed if elapsed else 0
+        self.stdout.write("Processed %d addresses in %.2fs (%.1f/s); %s\n" % (
+            processed, elapsed, rate,
+            ', '.join('%s: %d' % item for item in sorted(totals.items())) or 'nothing to do'))
+
+    def _read_emails(self, source):
+        for line, row in enumerate(csv.reader(source)):
+            email = row[0].strip() if row else ''
+            # Skip blank lines and a header row such as "email"; anything
+            # else is left to the validation, which reports bad addresses.
+            if not email or (line == 0 and '@' not in email):
+                continue
+            yield email
@@ -5,8 +5,14 @@ invitations which were never activated) from the database.
 Calls ``Invitation.objects.delete_expired_invitations()``, which
 contains the actual logic for determining which invitations are deleted.
 
+Rows are deleted in small chunks, each in its own transaction, so the
+command can safely run from cron on a busy site; ``--sleep`` and
+``--limit`` throttle it further.
+
 """
 
+from optparse import make_option
+
 from django.core.management.base import NoArgsCommand
 
 from invitation.models import Invitation
@@ -14,6 +20,31 @@ from invitation.models import Invitation
 
 class Command(NoArgsCommand):
     help = "Delete expired invitations from the database"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+                    help='Number of invitations deleted per transaction.'),
+        make_option('--sleep', dest='sleep', type='float', default=0,
+                    help='Seconds to pause between batches.'),
+        make_option('--limit', dest='limit', type='int', default=None,
+                    help='Maximum number of invitations deleted in this run.'),
+        make_option('--dry-run', dest='dry_run', action='store_true', default=False,
+                    help='Only report how many invitations would be deleted.'),
+    )
 
     def handle_noargs(self, **options):
-        Invitation.objects.delete_expired_invitations()
+        verbosity = int(options['verbosity'])
+        if options['dry_run']:
+            count = Invitation.objects.delete_expired_invitations(limit=options['limit'],
+                                                                  dry_run=True)
+            self.stdout.write("%d expired invitations would be deleted\n" % count)
+            return
+
+        progress = None
+        if verbosity > 1:
+            progress = lambda deleted: self.stdout.write("Deleted %d expired invitations\n" % deleted)
+        count = Invitation.objects.delete_expired_invitations(batch_size=options['batch_size'],
+                                                              limit=options['limit'],
+                                                              sleep=options['sleep'],
+                                                              progress=progress)
+        if verbosity > 0:
+            self.stdout.write("Deleted %d expired invitations\n" % count)
@@ -0,0 +1,58 @@
+"""
+A management command which exports invitations as CSV or JSON lines, or
+prints invitation statistics.
+
+The export is streamed to standard output (or ``--output``) in primary key
+order, ``--batch-size`` rows per query, so it runs in constant memory
+whatever the size of the table. ``--stats`` instead prints the number of
+invitations by status, inviter or day, using one aggregate query.
+
+"""
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from invitation.export import (csv_lines, jsonl_lines, iter_invitations, invitation_stats,
+                               stats_fields, EXPORT_FIELDS, FORMATS, STATS_DIMENSIONS)
+
+
+class Command(NoArgsCommand):
+    help = "Export invitations as CSV or JSON lines, or print invitation statistics"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--format', dest='format', default='csv',
+                    help='Output format: csv (default) or jsonl.'),
+        make_option('--stats', dest='stats', default=None,
+                    help='Print counts by status, inviter or day instead of exporting.'),
+        make_option('--output', dest='output', default=None,
+                    help='Write to this file instead of standard output.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=2000,
+                    help='Number of invitations read per query.'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['format'] not in FORMATS:
+            raise CommandError("Unknown format '%s', expected one of %s"
+                               % (options['format'], ', '.join(FORMATS)))
+        if options['stats'] is not None and options['stats'] not in STATS_DIMENSIONS:
+            raise CommandError("Unknown statistics '%s', expected one of %s"
+                               % (options['stats'], ', '.join(STATS_DIMENSIONS)))
+
+        if options['stats'] is not None:
+            rows = invitation_stats(options['stats'])
+            fields = stats_fields(options['stats'])
+        else:
+            rows = iter_invitations(chunk_size=options['batch_size'])
+            fields = EXPORT_FIELDS
+
+        output = open(options['output'], 'wb') if options['output'] else self.stdout
+        try:
+            if options['format'] == 'csv':
+                lines = csv_lines(rows, fields)
+            else:
+                lines = jsonl_lines(rows)
+            for line in lines:
+                output.write(line)
+        finally:
+            if output is not self.stdout:
+                output.close()
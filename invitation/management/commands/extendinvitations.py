@@ -0,0 +1,63 @@
+"""
+A management command which extends unused invitations, e.g. when the
+deadline of an invitation campaign slips.
+
+Calls ``Invitation.objects.extend_invitations()``, which updates the
+matching invitations in chunks with one ``UPDATE`` each and can send the
+invitation emails again.
+
+"""
+
+import datetime
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.utils import timezone
+
+from invitation.models import Invitation
+
+
+class Command(NoArgsCommand):
+    help = "Extend unused invitations"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', dest='days', type='int', default=None,
+                    help='Days from now the invitations will expire '
+                         '(defaults to ACCOUNT_INVITATION_DAYS).'),
+        make_option('--inviter', dest='inviter', default=None,
+                    help='Only extend invitations sent by this username.'),
+        make_option('--older-than', dest='older_than', type='int', default=None,
+                    help='Only extend invitations sent more than this many days ago.'),
+        make_option('--domain', dest='domain', default=None,
+                    help='Only extend invitations sent to addresses at this domain.'),
+        make_option('--resend', dest='resend', action='store_true', default=False,
+                    help='Send the invitation emails again.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+                    help='Number of invitations updated per query.'),
+    )
+
+    def handle_noargs(self, **options):
+        queryset = Invitation.objects.all()
+        if options['inviter']:
+            queryset = queryset.filter(from_user__username=options['inviter'])
+        if options['older_than'] is not None:
+            if options['older_than'] < 0:
+                raise CommandError("--older-than must not be negative")
+            queryset = queryset.filter(date_invited__lt=timezone.now() -
+                                       datetime.timedelta(options['older_than']))
+        if options['domain']:
+            queryset = queryset.filter(email__endswith='@%s' % options['domain'].lower())
+
+        verbosity = int(options['verbosity'])
+        progress = None
+        if verbosity > 1:
+            progress = lambda extended: self.stdout.write("Extended %d invitations\n" % extended)
+        started = time.time()
+        count = Invitation.objects.extend_invitations(queryset, days=options['days'],
+                                                      resend=options['resend'],
+                                                      batch_size=options['batch_size'],
+                                                      progress=progress)
+        elapsed = time.time() - started
+        if verbosity > 0:
+            self.stdout.write("Extended %d invitations in %.2fs (%.1f/s)\n" % (
+                count, elapsed, count / elapsed if elapsed else 0))
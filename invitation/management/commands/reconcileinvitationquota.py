@@ -0,0 +1,23 @@
+"""
+A management command which recounts the invitations sent by each user
+and refreshes the cached counts used for the ``INVITATIONS_PER_USER``
+quota.
+
+The cached counts are kept up to date as invitations are created and
+deleted; run this after changing invitations behind Django's back (e.g.
+with raw SQL), or after a cache outage.
+
+"""
+
+from django.core.management.base import NoArgsCommand
+
+from invitation.models import Invitation
+
+
+class Command(NoArgsCommand):
+    help = "Recount the invitations sent by each user for the invitation quota"
+
+    def handle_noargs(self, **options):
+        count = Invitation.objects.reconcile_sent_counts()
+        if int(options['verbosity']) > 0:
+            self.stdout.write("Reconciled invitation counts for %d users\n" % count)
@@ -0,0 +1,54 @@
+"""
+A management command which delivers invitation emails waiting in the
+outbox (see the ``INVITATION_QUEUE_EMAILS`` setting).
+
+Calls ``InvitationDelivery.objects.deliver_pending()`` in batches, over
+one mail connection, until no due emails remain. With ``--loop`` it keeps
+polling the outbox, which makes it suitable to run as a worker process.
+
+"""
+
+import time
+from optparse import make_option
+
+from django.core.mail import get_connection
+from django.core.management.base import NoArgsCommand
+
+from invitation.models import InvitationDelivery
+
+
+class Command(NoArgsCommand):
+    help = "Send invitation emails queued in the outbox"
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=100,
+                    help='Number of emails fetched from the outbox per batch.'),
+        make_option('--loop', dest='loop', action='store_true', default=False,
+                    help='Keep polling the outbox instead of exiting once it is drained.'),
+        make_option('--interval', dest='interval', type='float', default=5,
+                    help='Seconds to wait between polls when the outbox is empty.'),
+    )
+
+    def handle_noargs(self, **options):
+        connection = get_connection()
+        verbosity = int(options['verbosity'])
+        while True:
+            connection.open()
+            try:
+                totals = self._drain(connection, options['batch_size'])
+            finally:
+                connection.close()
+            if verbosity > 0 and any(totals):
+                self.stdout.write("Sent %d, retrying %d, failed %d\n" % totals)
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def _drain(self, connection, batch_size):
+        sent = retried = failed = 0
+        while True:
+            batch = InvitationDelivery.objects.deliver_pending(batch_size, connection)
+            if not any(batch):
+                return (sent, retried, failed)
+            sent += batch[0]
+            retried += batch[1]
+            failed += batch[2]
@@ -1,44 +1,471 @@
 import datetime
-import random
+import time
+import uuid
 
 from django.conf import settings
 from django.contrib.auth.models import User, Group
 from django.contrib.sites.models import Site
-from django.core.mail import send_mail
-from django.db import models
-from django.template.loader import render_to_string
-from django.utils.hashcompat import sha_constructor
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.mail import get_connection
+from django.core.validators import validate_email
+from django.db import IntegrityError, connection, models, router, transaction
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_delete, post_save
 from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
 
-__all__ = ['Invitation']
+from invitation import background
+from invitation.codes import generate_codes
+from invitation.instrumentation import stage
+from invitation.mailer import (InvitationMailer, DEFAULT_MESSAGE_TEMPLATE,
+                               DEFAULT_SUBJECT_TEMPLATE)
+
+__all__ = ['Invitation', 'InvitationDelivery']
+
+# Per-address outcomes reported by ``create_invitations_bulk``.
+BULK_INVITED = 'invited'
+BULK_DUPLICATE = 'duplicate'
+BULK_INVALID = 'invalid'
+BULK_ALREADY_INVITED = 'already invited'
+BULK_ALREADY_REGISTERED = 'already registered'
+
+# Values of ``Invitation.delivery_status`` for emails sent through the outbox.
+DELIVERY_QUEUED = 'queued'
+DELIVERY_SENT = 'sent'
+DELIVERY_FAILED = 'failed'
+DELIVERY_STATUS_CHOICES = (
+    (DELIVERY_QUEUED, _('Queued')),
+    (DELIVERY_SENT, _('Sent')),
+    (DELIVERY_FAILED, _('Failed')),
+)
+
+# Values of the ``status`` column added by ``annotate_status()``.
+STATUS_PENDING = 'pending'
+STATUS_EXPIRED = 'expired'
+STATUS_USED = 'used'
+
+# How many times a colliding invitation code is regenerated before giving up.
+CODE_ATTEMPTS = 5
+
+# Most values passed to a single ``IN`` lookup; SQLite allows 999 query
+# parameters.
+QUERY_CHUNK_SIZE = 500
+
+# Cached ``lookup()`` results are only valid for the generation stored here.
+LOOKUP_GENERATION_KEY = 'invitation:code:generation'
+
+
+def _sent_count_key(user_id):
+    return 'invitation:sent:%s' % user_id
+
+
+def _lookup_key(code):
+    return 'invitation:code:%s' % code
+
+
+def _lookup_timeout():
+    return getattr(settings, 'INVITATION_LOOKUP_CACHE_TIMEOUT', 60 * 5)
+
+
+def _adjust_sent_count(user_id, delta):
+    """
+    Apply ``delta`` to the cached number of invitations sent by a user.
+    Nothing is cached when the count was never read; it will be counted
+    afresh from the database when it is.
+    """
+    try:
+        cache.incr(_sent_count_key(user_id), delta)
+    except ValueError:
+        pass
+
+
+def _db_for_write(manager):
+    """
+    Return the database ``manager`` writes to. The reads a write depends
+    on, e.g. uniqueness checks, are made there too rather than on a replica
+    which may lag behind.
+    """
+    return manager._db or router.db_for_write(manager.model)
+
+
+def _resolve_groups(groups):
+    """
+    Return ``groups``, a sequence of ``Group`` objects and group names, as
+    a list of ``Group`` objects, looking all the names up in one query.
+    """
+    groups = list(groups or ())
+    names = [group for group in groups if isinstance(group, basestring)]
+    resolved = [group for group in groups if not isinstance(group, basestring)]
+    if names:
+        found = list(Group.objects.filter(name__in=names))
+        missing = set(names) - set(group.name for group in found)
+        if missing:
+            raise Group.DoesNotExist("Unknown groups: %s" % ', '.join(sorted(missing)))
+        resolved.extend(found)
+    return resolved
+
+
+def _chunks(values, size=QUERY_CHUNK_SIZE):
+    """
+    Split ``values`` into lists of at most ``size`` items, so that each
+    ``IN`` lookup stays within the database's limit on query parameters.
+    """
+    values = list(values)
+    for i in xrange(0, len(values), size):
+        yield values[i:i + size]
+
+
+class InvitationQuerySet(QuerySet):
+    """
+    Evaluates the state of invitations in the database, so listings and
+    counts never need to load and test each row in Python.
+    """
+    def pending(self):
+        """
+        Unused invitations which have not expired.
+        """
+        return self.filter(used=False, expiration_date__gte=timezone.now())
+
+    def expired(self):
+        """
+        Unused invitations past their expiration date.
+        """
+        return self.filter(used=False, expiration_date__lt=timezone.now())
+
+    def used(self):
+        return self.filter(used=True)
+
+    def annotate_status(self):
+        """
+        Add a ``status`` column holding one of ``STATUS_PENDING``,
+        ``STATUS_EXPIRED`` and ``STATUS_USED``.
+        """
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        sql = ("CASE WHEN %s.%s = %%s THEN '%s' WHEN %s.%s < %%s THEN '%s' ELSE '%s' END"
+               % (table, qn('used'), STATUS_USED, table, qn('expiration_date'),
+                  STATUS_EXPIRED, STATUS_PENDING))
+        return self.extra(select={'status': sql}, select_params=(True, timezone.now()))
+
 
 class InvitationManager(models.Manager):
-    def create_invitation(self, user, email):
+    def get_query_set(self):
+        return InvitationQuerySet(self.model, using=self._db)
+
+    def pending(self):
+        return self.get_query_set().pending()
+
+    def expired(self):
+        return self.get_query_set().expired()
+
+    def used(self):
+        return self.get_query_set().used()
+
+    def annotate_status(self):
+        return self.get_query_set().annotate_status()
+
+    def create_invitation(self, user, email, groups=None):
         """
-        Create an ``Invitation`` and returns it.
+        Create an ``Invitation`` and returns it. The user who accepts it
+        will be added to ``groups``, ``Group`` objects or group names.
         
-        The code for the ``Invitation`` will be a SHA1 hash, generated
-        from a combination of the ``User``'s username and a random salt.
+        The code for the ``Invitation`` is made by the code generator
+        configured with ``INVITATION_CODE_GENERATOR``; by default a short,
+        URL-safe string of random bytes. Should the code collide with an
+        existing one, a new code is generated and the insert retried.
         """
 
         kwargs = {'from_user': user, 'email': email}
-        date_invited = datetime.datetime.now()
+        date_invited = timezone.now()
         kwargs['date_invited'] = date_invited
-        #kwargs['groups':groups]
         kwargs['expiration_date'] = date_invited + datetime.timedelta(settings.ACCOUNT_INVITATION_DAYS)
-        salt = sha_constructor(str(random.random())).hexdigest()[:5]
-        kwargs['code'] = sha_constructor("%s%s%s" % (datetime.datetime.now(), salt, user.username)).hexdigest()
-        print kwargs
-        invite = self.create(**kwargs)
-        return invite
+        db = _db_for_write(self)
+        groups = _resolve_groups(groups)
+        for attempt in range(CODE_ATTEMPTS):
+            kwargs['code'] = self._generate_code(user)
+            sid = transaction.savepoint(using=db)
+            try:
+                invite = self.using(db).create(**kwargs)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid, using=db)
+                # Only retry when it was the code, and not e.g. the
+                # email address, that clashed.
+                if (attempt + 1 == CODE_ATTEMPTS or
+                        not self.using(db).filter(code=kwargs['code']).exists()):
+                    raise
+            else:
+                transaction.savepoint_commit(sid, using=db)
+                if groups:
+                    self.db_manager(db)._add_groups([invite], groups)
+                return invite
+
+    def create_invitations_bulk(self, user, emails, batch_size=500, send=True,
+                                connection=None, mailer=None, groups=None):
+        """
+        Create (and optionally send) ``Invitation`` objects from ``user``
+        to every address in ``emails``, to join ``groups`` on acceptance.
+
+        Addresses are processed ``batch_size`` at a time: each batch is
+        de-duplicated, checked against existing invitations and users in
+        two queries, written with a single ``bulk_create`` (plus one for
+        the groups, which are only looked up once) and mailed
+        through one reused mail connection, rendered by ``mailer`` (an
+        ``InvitationMailer`` with the default templates if not given).
+
+        Returns a list of ``(email, result)`` pairs, one per supplied
+        address, where ``result`` is one of the ``BULK_*`` constants.
+        """
+        return list(self.iter_invitations_bulk(user, emails, batch_size, send, connection,
+                                               mailer, groups))
+
+    def iter_invitations_bulk(self, user, emails, batch_size=500, send=True,
+                              connection=None, mailer=None, groups=None):
+        """
+        Like ``create_invitations_bulk``, but yield the ``(email, result)``
+        pairs as each batch is written, so that an arbitrarily long stream
+        of addresses can be invited without holding it in memory. Repeated
+        addresses are reported as duplicates across the whole stream.
+        """
+        results = []
+        seen = set()
+        # Positions in ``results`` of the addresses in ``batch``, whose
+        # results are only known once the batch is written.
+        positions = []
+        batch = []
+        if send and connection is None:
+            connection = get_connection()
+        if send and mailer is None:
+            mailer = InvitationMailer()
+        groups = _resolve_groups(groups)
+        for email in emails:
+            email = email.strip().lower()
+            try:
+                validate_email(email)
+            except ValidationError:
+                results.append((email, BULK_INVALID))
+                continue
+            if email in seen:
+                results.append((email, BULK_DUPLICATE))
+                continue
+            seen.add(email)
+            positions.append(len(results))
+            results.append(None)
+            batch.append(email)
+            if len(batch) >= batch_size:
+                self._fill_results(results, positions,
+                                   self._create_invitations_batch(user, batch, send, connection,
+                                                                  mailer, groups))
+                for result in results:
+                    yield result
+                results, positions, batch = [], [], []
+        if batch:
+            self._fill_results(results, positions,
+                               self._create_invitations_batch(user, batch, send, connection,
+                                                              mailer, groups))
+        for result in results:
+            yield result
+
+    def _fill_results(self, results, positions, batch_results):
+        for position, result in zip(positions, batch_results):
+            results[position] = result
+
+    def _create_invitations_batch(self, user, emails, send, connection, mailer, groups):
+        db = _db_for_write(self)
+        manager = self.db_manager(db)
+        invited, registered = manager.unavailable_emails(emails)
+        results = []
+        invitations = []
+        date_invited = timezone.now()
+        expiration_date = date_invited + datetime.timedelta(settings.ACCOUNT_INVITATION_DAYS)
+        for email in emails:
+            if email in invited:
+                results.append((email, BULK_ALREADY_INVITED))
+            elif email in registered:
+                results.append((email, BULK_ALREADY_REGISTERED))
+            else:
+                invitations.append(self.model(from_user=user, email=email,
+                                              date_invited=date_invited,
+                                              expiration_date=expiration_date))
+                results.append((email, BULK_INVITED))
+        if invitations:
+            codes = manager._generate_unique_codes(user, len(invitations))
+            for invitation, code in zip(invitations, codes):
+                invitation.code = code
+            queue = send and getattr(settings, 'INVITATION_QUEUE_EMAILS', False)
+            if queue:
+                for invitation in invitations:
+                    invitation.delivery_status = DELIVERY_QUEUED
+            manager.bulk_create(invitations)
+            # bulk_create() sends no post_save signals.
+            _adjust_sent_count(user.pk, len(invitations))
+            if queue or groups:
+                # bulk_create() does not set primary keys, so fetch them
+                # back in one query before adding the related rows.
+                pks = {}
+                for chunk in _chunks(invitation.email for invitation in invitations):
+                    pks.update(manager.filter(email__in=chunk).values_list('email', 'pk'))
+                for invitation in invitations:
+                    invitation.pk = pks[invitation.email]
+            if groups:
+                manager._add_groups(invitations, groups)
+            if queue:
+                InvitationDelivery.objects.db_manager(db).queue(invitations)
+            elif send:
+                mailer.send(invitations, connection=connection)
+        return results
+
+    def _add_groups(self, invitations, groups):
+        """
+        Add each of the new ``invitations`` to every one of ``groups`` with
+        a single insert.
+        """
+        through = self.model.groups.through
+        through.objects.db_manager(self._db).bulk_create(
+            [through(invitation_id=invitation.pk, group_id=group.pk)
+             for invitation in invitations for group in groups])
+
+    def send_invitations(self, invitations, mailer=None, connection=None, queue=None):
+        """
+        Send the emails for ``invitations``, a list or queryset, in bulk:
+        rendered by ``mailer`` and sent over one connection or, when
+        queueing (see ``Invitation.send()``), added to the outbox with a
+        single insert. Returns the number of invitations.
+        """
+        invitations = list(invitations)
+        if not invitations:
+            return 0
+        if queue is None:
+            queue = getattr(settings, 'INVITATION_QUEUE_EMAILS', False)
+        if queue:
+            InvitationDelivery.objects.db_manager(self._db).queue(invitations)
+            for chunk in _chunks(invitation.pk for invitation in invitations):
+                self.filter(pk__in=chunk).update(delivery_status=DELIVERY_QUEUED)
+        else:
+            (mailer or InvitationMailer()).send(invitations, connection=connection)
+        return len(invitations)
+
+    def unavailable_emails(self, emails):
+        """
+        Check normalized (stripped and lowercased) ``emails`` against
+        existing invitations and users.
+
+        Returns an ``(invited, registered)`` pair of sets: the addresses
+        which have already been sent an invitation, and those of the rest
+        which belong to a registered user. Invitation addresses are stored
+        normalized, so the first check is an equality lookup on the unique
+        index; the user check is skipped when every address was invited.
+        Each check takes one query per ``QUERY_CHUNK_SIZE`` addresses.
+        """
+        emails = list(emails)
+        invited = set()
+        for chunk in _chunks(emails):
+            invited.update(self.filter(email__in=chunk).values_list('email', flat=True))
+        remaining = [email for email in emails if email not in invited]
+        registered = set()
+        users = User.objects.db_manager(self._db)
+        for chunk in _chunks(remaining):
+            # User addresses are not normalized, so compare them lowercased.
+            where = 'LOWER(email) IN (%s)' % ', '.join(['%s'] * len(chunk))
+            registered.update(email.lower() for email in
+                              users.extra(where=[where], params=chunk)
+                                   .values_list('email', flat=True))
+        return invited, registered
+
+    def _generate_code(self, user):
+        with stage('code'):
+            return generate_codes(user, 1)[0]
+
+    def _generate_unique_codes(self, user, count):
+        """
+        Generate ``count`` distinct codes which are not yet in use, checking
+        them against the database in one query per round and
+        ``QUERY_CHUNK_SIZE`` codes.
+        """
+        codes = set()
+        for attempt in range(CODE_ATTEMPTS):
+            candidates = set(generate_codes(user, count - len(codes))) - codes
+            for chunk in _chunks(candidates):
+                candidates -= set(self.filter(code__in=chunk).values_list('code', flat=True))
+            codes |= candidates
+            if len(codes) == count:
+                return list(codes)
+        raise IntegrityError("Could not generate %d unique invitation codes" % count)
+
+    def claim_invitation(self, code, user=None):
+        """
+        Mark the ``Invitation`` with the given code as used (by ``user``,
+        if given), provided it is still unused and has not expired.
+
+        This is a single conditional ``UPDATE``, so when several requests
+        race to accept the same invitation only one of them can claim it.
+        Returns ``True`` if the invitation was claimed by this call.
+        """
+        kwargs = {'used': True}
+        if user is not None:
+            kwargs['to_user'] = user
+        claimed = bool(self.pending().filter(code=code).update(**kwargs))
+        if claimed:
+            self.invalidate_lookups([code])
+        return claimed
+
+    def lookup(self, code):
+        """
+        Return the ``Invitation`` with the given code, or ``None`` if there
+        is none, going through the cache.
+
+        Found invitations are cached for ``INVITATION_LOOKUP_CACHE_TIMEOUT``
+        seconds (five minutes by default), unknown codes for
+        ``INVITATION_LOOKUP_NEGATIVE_CACHE_TIMEOUT`` seconds (30 by
+        default). Entries are dropped when an invitation is saved, claimed,
+        extended or deleted, so repeated requests for the same link are
+        served from the cache with a single round trip.
+        """
+        if len(code) > self.model._meta.get_field('code').max_length:
+            return None
+        key = _lookup_key(code)
+        cached = cache.get_many([key, LOOKUP_GENERATION_KEY])
+        generation = cached.get(LOOKUP_GENERATION_KEY)
+        if generation is None:
+            generation = time.time()
+            if not cache.add(LOOKUP_GENERATION_KEY, generation, _lookup_timeout()):
+                # Another process started a generation meanwhile; don't
+                # cache under ours.
+                generation = None
+        elif key in cached and cached[key][0] == generation:
+            return cached[key][1]
+
+        try:
+            invitation = self.get(code=code)
+        except self.model.DoesNotExist:
+            invitation = None
+        if generation is not None:
+            if invitation is None:
+                timeout = getattr(settings, 'INVITATION_LOOKUP_NEGATIVE_CACHE_TIMEOUT', 30)
+            else:
+                timeout = _lookup_timeout()
+            cache.set(key, (generation, invitation), timeout)
+        return invitation
+
+    def invalidate_lookups(self, codes=None):
+        """
+        Drop the cached ``lookup()`` results for ``codes``, or for every
+        code if ``codes`` is ``None``, after invitations were changed with
+        ``QuerySet.update()``.
+        """
+        if codes is None:
+            # Starting a new generation makes every cached entry stale
+            # without having to know their codes.
+            cache.set(LOOKUP_GENERATION_KEY, time.time(), _lookup_timeout())
+        else:
+            cache.delete_many([_lookup_key(code) for code in codes])
 
     def remaining_invitations_for_user(self, user):
         """ Returns the number of remaining invitations for a given ``User``
         if ``INVITATIONS_PER_USER`` has been set.
         """
         if hasattr(settings, 'INVITATIONS_PER_USER'):
-            inviteds_count = self.filter(from_user=user).count()
+            inviteds_count = self.sent_count(user)
             remaining_invitations = settings.INVITATIONS_PER_USER - inviteds_count
             if remaining_invitations < 0:
                 # Possible for admin to change INVITATIONS_PER_USER 
@@ -47,58 +474,395 @@ class InvitationManager(models.Manager):
                 return 0
             return remaining_invitations
 
-    def delete_expired_invitations(self):
+    def extend_invitations(self, queryset=None, days=None, resend=False, batch_size=1000,
+                           progress=None, mailer=None):
+        """
+        Extend the unused invitations in ``queryset`` (by default, all of
+        them) to expire ``days`` days from now, ``ACCOUNT_INVITATION_DAYS``
+        if not given.
+
+        Rows are updated in chunks of at most ``batch_size``, selected by
+        primary key range, with one ``UPDATE`` per chunk. With ``resend``
+        each chunk's invitation emails are sent (or queued) again, showing
+        the new expiration date, rendered by ``mailer`` if given.
+        ``progress``, if given, is called with the running total after
+        each chunk.
+
+        Returns the number of invitations extended.
+        """
+        if queryset is None:
+            queryset = self.all()
+        if days is None:
+            days = settings.ACCOUNT_INVITATION_DAYS
+        expiration_date = timezone.now() + datetime.timedelta(days)
+        pending = queryset.filter(used=False).order_by('pk')
+        if resend and mailer is None:
+            mailer = InvitationMailer()
+
+        extended = 0
+        last_pk = None
+        while True:
+            chunk = pending if last_pk is None else pending.filter(pk__gt=last_pk)
+            if resend:
+                invitations = list(chunk[:batch_size])
+                pks = [invitation.pk for invitation in invitations]
+            else:
+                pks = list(chunk.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            extended += pending.filter(pk__gte=pks[0], pk__lte=pks[-1]) \
+                               .update(expiration_date=expiration_date)
+            if resend:
+                # The UPDATE did not change the invitations already loaded.
+                for invitation in invitations:
+                    invitation.expiration_date = expiration_date
+                self.send_invitations(invitations, mailer=mailer)
+            last_pk = pks[-1]
+            if progress is not None:
+                progress(extended)
+        if extended:
+            self.invalidate_lookups()
+        return extended
+
+    def sent_count(self, user):
+        """
+        Returns the number of invitations sent by ``user``.
+
+        The count is kept in the cache for ``INVITATION_QUOTA_CACHE_TIMEOUT``
+        seconds (a day by default) and updated as invitations are created
+        and deleted, so it is only counted in the database on a cache miss.
+        """
+        key = _sent_count_key(user.pk)
+        count = cache.get(key)
+        if count is None:
+            count = self.filter(from_user=user).count()
+            cache.add(key, count, getattr(settings, 'INVITATION_QUOTA_CACHE_TIMEOUT', 60 * 60 * 24))
+        return count
+
+    def reconcile_sent_counts(self, batch_size=1000):
+        """
+        Recount the invitations sent by every user with one ``GROUP BY``
+        query and store the results in the cache, dropping the cached
+        counts of users who have sent none. Returns the number of users
+        with invitations.
+        """
+        timeout = getattr(settings, 'INVITATION_QUOTA_CACHE_TIMEOUT', 60 * 60 * 24)
+        counts = dict(self.values_list('from_user').annotate(count=models.Count('pk'))
+                          .order_by())
+        items = counts.items()
+        for i in xrange(0, len(items), batch_size):
+            cache.set_many(dict((_sent_count_key(user_id), count)
+                                for user_id, count in items[i:i + batch_size]), timeout)
+        stale = []
+        for user_id in User.objects.values_list('pk', flat=True).iterator():
+            if user_id not in counts:
+                stale.append(_sent_count_key(user_id))
+            if len(stale) >= batch_size:
+                cache.delete_many(stale)
+                stale = []
+        if stale:
+            cache.delete_many(stale)
+        return len(counts)
+
+    def delete_expired_invitations(self, batch_size=1000, limit=None, sleep=0,
+                                   dry_run=False, progress=None):
         """
         Deletes all unused ``Invitation`` objects that are past the expiration date
+
+        Invitations are deleted in chunks of at most ``batch_size`` rows,
+        selected by primary key range, each in its own transaction, so the
+        table is never locked for long. ``limit`` caps the number of rows
+        deleted in total, ``sleep`` pauses (in seconds) between chunks and
+        ``progress``, if given, is called with the running total after
+        each chunk. With ``dry_run`` nothing is deleted.
+
+        Each chunk is deleted with direct ``DELETE`` queries, along with its
+        outbox rows and group links, and no delete signals are sent. The
+        cached sent counts are instead adjusted once per inviter and the
+        cached ``lookup()`` results dropped once per chunk.
+
+        Returns the number of invitations deleted (or which would be).
+        """
+        db = _db_for_write(self)
+        expired = self.using(db).expired()
+        if dry_run:
+            count = expired.count()
+            return count if limit is None else min(count, limit)
+
+        deleted = 0
+        last_pk = None
+        while limit is None or deleted < limit:
+            size = batch_size if limit is None else min(batch_size, limit - deleted)
+            chunk = expired.order_by('pk')
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            pks = list(chunk.values_list('pk', flat=True)[:size])
+            if not pks:
+                break
+            with transaction.commit_on_success(using=db):
+                sent = self._purge(expired.filter(pk__gte=pks[0], pk__lte=pks[-1]), db)
+            for user_id, count in sent:
+                _adjust_sent_count(user_id, -count)
+            self.invalidate_lookups()
+            deleted += len(pks)
+            last_pk = pks[-1]
+            if progress is not None:
+                progress(deleted)
+            if sleep and len(pks) == size:
+                time.sleep(sleep)
+        return deleted
+
+    def _purge(self, queryset, db):
+        """
+        Delete the unused invitations in ``queryset``, with their outbox
+        rows and group links, without loading them or sending a signal
+        per row. Returns ``(user_id, count)`` pairs of the invitations
+        deleted per inviter.
         """
-        self.filter(expiration_date__lt=datetime.datetime.now(), used=False).delete()
+        sent = list(queryset.values_list('from_user')
+                            .annotate(count=models.Count('pk')).order_by())
+        pks = queryset.values('pk')
+        InvitationDelivery.objects.using(db).filter(invitation__in=pks)._raw_delete(db)
+        self.model.groups.through.objects.using(db).filter(invitation__in=pks)._raw_delete(db)
+        queryset._raw_delete(db)
+        return sent
 
 
 class Invitation(models.Model):
-    code = models.CharField(_('invitation code'), max_length=40)
-    date_invited = models.DateTimeField(_('date invited'))
+    code = models.CharField(_('invitation code'), max_length=40, unique=True)
+    date_invited = models.DateTimeField(_('date invited'), db_index=True)
     expiration_date = models.DateTimeField()
     used = models.BooleanField(default=False)
     from_user = models.ForeignKey(User, related_name='invitations_sent')
     to_user = models.ForeignKey(User, null=True, blank=True, related_name='invitation_received')
     email = models.EmailField(unique=True)
+    delivery_status = models.CharField(_('delivery status'), max_length=10, blank=True,
+                                       choices=DELIVERY_STATUS_CHOICES)
+    groups = models.ManyToManyField(Group, verbose_name=_('groups'), blank=True,
+                                    related_name='invitations',
+                                    help_text=_('Groups the invited user will join.'))
 
     objects = InvitationManager()
 
+    class Meta:
+        # Keeps each chunk of ``delete_expired_invitations`` an index scan.
+        index_together = [['used', 'expiration_date']]
+
     def __unicode__(self):
         return u"Invitation from %s to %s" % (self.from_user.username, self.email)
 
+    def save(self, *args, **kwargs):
+        # Addresses are stored normalized so that uniqueness checks can
+        # use the unique index instead of a case-insensitive scan.
+        self.email = self.email.strip().lower()
+        super(Invitation, self).save(*args, **kwargs)
+
     def expired(self):
-        return timezone.make_aware(self.expiration_date,timezone.get_default_timezone()) < timezone.now()
+        return self.expiration_date < timezone.now()
 
     def send(self, from_email=settings.DEFAULT_FROM_EMAIL,
-        subject_template='invitation/invitation_email_subject.txt',
-        message_template='invitation/invitation_email.txt'):
+        subject_template=DEFAULT_SUBJECT_TEMPLATE,
+        message_template=DEFAULT_MESSAGE_TEMPLATE, queue=None):
         
         """
         Send an invitation email.
-        """
-        current_site = Site.objects.get_current()
 
-        subject = render_to_string(subject_template,
-                                   {'invitation': self,
-                                    'site': current_site})
-        # Email subject *must not* contain newlines
-        subject = ''.join(subject.splitlines())
+        If ``queue`` is true, or is left as ``None`` and the
+        ``INVITATION_QUEUE_EMAILS`` setting is true, the email is added to
+        the outbox instead, to be delivered by the ``sendinvitations``
+        command. Invitations which are not in the database (see
+        ``invitation.stores.CacheInvitationStore``) are always sent at once.
+
+        Otherwise, with ``INVITATION_SEND_IN_BACKGROUND`` set, the email is
+        sent from a worker thread (see ``invitation.background``) and this
+        method returns without waiting for the mail server. The email is
+        handed over with ``background.defer()``, so that within a request
+        handled by ``DeferredJobsMiddleware`` it is only sent once the
+        invitation is committed. If sending it fails, it is added to the
+        outbox to be retried.
+        """
+        if queue is None:
+            queue = getattr(settings, 'INVITATION_QUEUE_EMAILS', False)
+        if queue and self.pk is not None:
+            InvitationDelivery.objects.queue([self], from_email, subject_template,
+                                             message_template)
+            self.delivery_status = DELIVERY_QUEUED
+            Invitation.objects.filter(pk=self.pk).update(delivery_status=DELIVERY_QUEUED)
+        elif getattr(settings, 'INVITATION_SEND_IN_BACKGROUND', False):
+            # Read the site and the inviter, which invitation emails usually
+            # show, from the database here rather than in the worker thread.
+            mailer = InvitationMailer(from_email, subject_template, message_template,
+                                      site=Site.objects.get_current())
+            if not Invitation.from_user.is_cached(self):
+                self.from_user = User.objects.get(pk=self.from_user_id)
+            background.defer(_send_in_background, self, mailer,
+                             using=self._state.db or router.db_for_write(Invitation))
+        else:
+            InvitationMailer(from_email, subject_template, message_template).send([self])
 
-        message = render_to_string(message_template,
-                                   {'invitation': self,
-                                    'expiration_days': settings.ACCOUNT_INVITATION_DAYS,
-                                    'site': current_site})
+    def render_email(self, from_email=settings.DEFAULT_FROM_EMAIL,
+        subject_template=DEFAULT_SUBJECT_TEMPLATE,
+        message_template=DEFAULT_MESSAGE_TEMPLATE, site=None):
 
-        send_mail(subject, message, from_email, [self.email])
+        """
+        Render the invitation email and return it as a
+        ``(subject, message, from_email, recipient_list)`` tuple, as
+        expected by ``send_mass_mail``. Use an ``InvitationMailer`` to
+        render many invitations.
+        """
+        return InvitationMailer(from_email, subject_template, message_template,
+                                site=site).render(self)
 
     #Extends the invitation for X days from the time it's called, where X is the account_invitation_days
     def extend(self):
-        date_now = datetime.datetime.now()
-        extend_time = timedelta(days=settings.ACCOUNT_INVITATION_DAYS)
+        date_now = timezone.now()
+        extend_time = datetime.timedelta(days=settings.ACCOUNT_INVITATION_DAYS)
         self.expiration_date = date_now + extend_time
-        self.save()
+        self.save(update_fields=['expiration_date'])
+
+
+def _send_in_background(invitation, mailer):
+    """
+    Send ``invitation`` with ``mailer``, from a worker thread. If that
+    fails, queue the email in the outbox, where ``sendinvitations`` will
+    retry it, rather than only logging the error.
+    """
+    try:
+        mailer.send([invitation])
+    except Exception:
+        if invitation.pk is None:
+            raise
+        background.logger.exception("Sending the invitation to %s failed, queueing it"
+                                    % invitation.email)
+        InvitationDelivery.objects.queue([invitation], mailer.from_email,
+                                         mailer.subject_template, mailer.message_template)
+        Invitation.objects.filter(pk=invitation.pk).update(delivery_status=DELIVERY_QUEUED)
+
+
+class InvitationDeliveryManager(models.Manager):
+    def queue(self, invitations, from_email=settings.DEFAULT_FROM_EMAIL,
+              subject_template=DEFAULT_SUBJECT_TEMPLATE,
+              message_template=DEFAULT_MESSAGE_TEMPLATE):
+        """
+        Add an outbox entry for each of the (saved) ``invitations``.
+        """
+        now = timezone.now()
+        self.bulk_create([self.model(invitation_id=invitation.pk, from_email=from_email,
+                                     subject_template=subject_template,
+                                     message_template=message_template,
+                                     next_attempt=now)
+                          for invitation in invitations])
+
+    def deliver_pending(self, batch_size=100, connection=None):
+        """
+        Send up to ``batch_size`` queued invitation emails which are due,
+        over a single mail connection.
+
+        The batch is first claimed with a conditional ``UPDATE``, which
+        tags the rows which are still due and postpones them by
+        ``INVITATION_DELIVERY_CLAIM_TIMEOUT`` seconds (10 minutes by
+        default), so overlapping runs never send the same email twice. The
+        emails of a run which dies are sent again once that has passed.
+
+        A failed email is retried with exponential backoff, starting at
+        ``INVITATION_DELIVERY_RETRY_DELAY`` seconds, until it has been
+        attempted ``INVITATION_DELIVERY_MAX_ATTEMPTS`` times; its
+        invitation is then marked as failed.
+
+        Returns a ``(sent, retried, failed)`` tuple of counts.
+        """
+        now = timezone.now()
+        # The outbox is a work queue, so read it from where it is written.
+        db = _db_for_write(self)
+        due = self.using(db).filter(next_attempt__lte=now)
+        pks = list(due.order_by('next_attempt').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return (0, 0, 0)
+        # Another run may have claimed some of the rows since; only those
+        # still due are updated, and only those tagged here are sent.
+        claim = uuid.uuid4().hex
+        claim_timeout = getattr(settings, 'INVITATION_DELIVERY_CLAIM_TIMEOUT', 10 * 60)
+        for chunk in _chunks(pks):
+            due.filter(pk__in=chunk).update(
+                claim=claim, next_attempt=now + datetime.timedelta(seconds=claim_timeout))
+        deliveries = list(self.using(db).select_related('invitation').filter(claim=claim)
+                              .order_by('pk'))
+        if not deliveries:
+            return (0, 0, 0)
+
+        max_attempts = getattr(settings, 'INVITATION_DELIVERY_MAX_ATTEMPTS', 5)
+        retry_delay = getattr(settings, 'INVITATION_DELIVERY_RETRY_DELAY', 60)
+        current_site = Site.objects.get_current()
+        # One mailer per sender, so each template is only compiled once.
+        mailers = {}
+        connection = connection or get_connection()
+        sent, failed = [], []
+        retried = 0
+        opened = connection.open()
+        try:
+            for delivery in deliveries:
+                if delivery.from_email not in mailers:
+                    mailers[delivery.from_email] = InvitationMailer(delivery.from_email,
+                                                                    site=current_site)
+                try:
+                    connection.send_messages([mailers[delivery.from_email].message(
+                        delivery.invitation, delivery.subject_template,
+                        delivery.message_template, connection=connection)])
+                except Exception as e:
+                    delivery.attempts += 1
+                    delivery.last_error = unicode(e)
+                    if delivery.attempts >= max_attempts:
+                        failed.append(delivery)
+                    else:
+                        delivery.claim = ''
+                        delivery.next_attempt = now + datetime.timedelta(
+                            seconds=retry_delay * 2 ** (delivery.attempts - 1))
+                        delivery.save(using=db)
+                        retried += 1
+                else:
+                    sent.append(delivery)
+        finally:
+            if opened:
+                connection.close()
+
+        for status, done in ((DELIVERY_SENT, sent), (DELIVERY_FAILED, failed)):
+            if done:
+                for chunk in _chunks(done):
+                    self.using(db).filter(pk__in=[d.pk for d in chunk]).delete()
+                    Invitation.objects.using(db).filter(pk__in=[d.invitation_id for d in chunk]) \
+                                      .update(delivery_status=status)
+        return (len(sent), retried, len(failed))
+
+
+class InvitationDelivery(models.Model):
+    """
+    An invitation email waiting in the outbox to be sent by the
+    ``sendinvitations`` command.
+    """
+    invitation = models.ForeignKey(Invitation, related_name='deliveries')
+    from_email = models.CharField(max_length=254)
+    subject_template = models.CharField(max_length=100)
+    message_template = models.CharField(max_length=100)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(db_index=True)
+    # Tags the rows a ``deliver_pending`` run has claimed.
+    claim = models.CharField(max_length=32, blank=True, db_index=True)
+    last_error = models.TextField(blank=True)
+
+    objects = InvitationDeliveryManager()
+
+    def __unicode__(self):
+        return u"Delivery of %s" % self.invitation_id
+
 
+def invitation_saved(sender, instance, created, **kwargs):
+    if created:
+        _adjust_sent_count(instance.from_user_id, 1)
+    cache.delete(_lookup_key(instance.code))
+post_save.connect(invitation_saved, sender=Invitation)
 
 
+def invitation_deleted(sender, instance, **kwargs):
+    _adjust_sent_count(instance.from_user_id, -1)
+    cache.delete(_lookup_key(instance.code))
+post_delete.connect(invitation_deleted, sender=Invitation)
@@ -0,0 +1,189 @@
+"""
+Rate limiting for the ``invite`` view.
+
+Rate limiting is off unless the ``INVITATION_RATE_LIMITER`` setting names
+a rate limiter class by its dotted path, such as
+``invitation.ratelimit.FixedWindowRateLimiter``. A rate limiter is
+instantiated with no arguments and has a single method,
+``throttle(request)``, which returns ``0`` when the request may go ahead,
+or else the number of seconds until it would be allowed.
+
+``INVITATION_RATE_LIMITS`` maps periods (``'minute'``, ``'hour'`` or
+``'day'``) to the number of invitations one user may send per period. It
+defaults to 10 a minute and 200 a day.
+
+The same limits apply per IP address when ``INVITATION_RATE_LIMIT_IP``
+names a callable taking the request and returning its client's address
+(or ``None``). ``invitation.ratelimit.remote_addr`` returns
+``REMOTE_ADDR``, which is only the client's address when no proxy stands
+in front of the site; behind one, every client would share a single
+count, so supply a callable which reads the address the proxy forwards.
+
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+
+from invitation.utils import import_from_setting
+
+DEFAULT_RATE_LIMITER = None
+DEFAULT_RATE_LIMITS = {'minute': 10, 'day': 200}
+
+PERIODS = {
+    'minute': 60,
+    'hour': 60 * 60,
+    'day': 24 * 60 * 60,
+}
+
+
+def remote_addr(request):
+    """
+    Return ``REMOTE_ADDR``, the client's address for a site which is not
+    behind a proxy.
+    """
+    return request.META.get('REMOTE_ADDR')
+
+
+class BaseRateLimiter(object):
+    """
+    Applies each of ``limits`` (by default ``INVITATION_RATE_LIMITS``) to
+    the requesting user, and to their IP address as returned by ``get_ip``
+    (by default the callable named by ``INVITATION_RATE_LIMIT_IP``, if any).
+    """
+    def __init__(self, limits=None, get_ip=None):
+        if limits is None:
+            limits = getattr(settings, 'INVITATION_RATE_LIMITS', DEFAULT_RATE_LIMITS)
+        try:
+            self.limits = [(period, PERIODS[period], limit) for period, limit in limits.items()]
+        except KeyError as e:
+            raise ImproperlyConfigured("Unknown invitation rate limit period %s, expected one of %s"
+                                       % (e, ', '.join(sorted(PERIODS))))
+        if get_ip is None:
+            path = getattr(settings, 'INVITATION_RATE_LIMIT_IP', None)
+            if path is not None:
+                get_ip = import_from_setting(path, 'invitation rate limit IP function')
+        self.get_ip = get_ip
+
+    def now(self):
+        return time.time()
+
+    def get_idents(self, request):
+        idents = []
+        if request.user.is_authenticated():
+            idents.append('user:%s' % request.user.pk)
+        ip = self.get_ip(request) if self.get_ip is not None else None
+        if ip:
+            idents.append('ip:%s' % ip)
+        return idents
+
+    def throttle(self, request):
+        raise NotImplementedError
+
+
+class FixedWindowRateLimiter(BaseRateLimiter):
+    """
+    Counts the requests of each user and IP address in fixed windows of
+    each period (e.g. each calendar minute), and refuses a request which
+    would take any count over its limit.
+
+    The counts of a request are first read with one ``get_many()``; a
+    request already over a limit is refused there, without touching them.
+    Otherwise each count is taken with its own ``incr()`` (plus an
+    ``add()`` for the first request of a window), which memcached applies
+    atomically, so concurrent requests can never together exceed a limit
+    (Django's locmem and database caches implement ``incr()`` as a read
+    and a write). With the default two limits, an allowed request costs one
+    ``get_many()`` and two ``incr()`` calls per user, and two more
+    ``incr()`` calls when IP addresses are limited too. A request which
+    only goes over a limit on its ``incr()``, having raced another, gives
+    back what it took with a ``decr()`` each. A client may send up to
+    twice a limit across the boundary between two windows.
+    """
+    def _incr(self, key, timeout):
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # First request of the window; add() is atomic too, so only
+            # one of several racing requests creates the counter.
+            if cache.add(key, 1, timeout):
+                return 1
+            return cache.incr(key)
+
+    def throttle(self, request):
+        now = self.now()
+        counters = []
+        for ident in self.get_idents(request):
+            for period, seconds, limit in self.limits:
+                window = int(now // seconds)
+                key = 'invitation:rate:%s:%s:%d' % (ident, period, window)
+                counters.append((key, seconds, limit, (window + 1) * seconds - now))
+        counts = cache.get_many([key for key, seconds, limit, until_next in counters])
+        wait = max([0] + [until_next for key, seconds, limit, until_next in counters
+                          if counts.get(key, 0) >= limit])
+        if wait:
+            return wait
+
+        counted = []
+        for key, seconds, limit, until_next in counters:
+            # Keep each counter a little past the end of its window.
+            count = self._incr(key, seconds + 60)
+            counted.append(key)
+            if count > limit:
+                wait = max(wait, until_next)
+        if wait:
+            for key in counted:
+                try:
+                    cache.decr(key)
+                except ValueError:
+                    pass
+        return wait
+
+
+class TokenBucketRateLimiter(BaseRateLimiter):
+    """
+    Keeps a token bucket in the cache for each limit, per user and per IP
+    address. A bucket holds at most ``limit`` tokens and refills at
+    ``limit`` tokens per period; each request takes a token from every
+    bucket, and is refused if any of them is empty.
+
+    All the buckets of a request are read with one ``get_many()`` and, if
+    the request is allowed, written back with one ``set_many()``. The two
+    are not atomic: every request which reads the buckets before the
+    first of them writes them back sees the same tokens, so a burst of
+    concurrent requests may all get through, however far over the limit.
+    Only use it where requests cannot race, and prefer
+    ``FixedWindowRateLimiter`` otherwise.
+    """
+    def throttle(self, request):
+        now = self.now()
+        buckets = dict(('invitation:rate:%s:%s' % (ident, period), (seconds, limit))
+                       for ident in self.get_idents(request)
+                       for period, seconds, limit in self.limits)
+        stored = cache.get_many(buckets.keys())
+        updated = {}
+        wait = 0
+        for key, (seconds, limit) in buckets.items():
+            tokens, last = stored.get(key, (limit, now))
+            tokens = min(limit, tokens + (now - last) * limit / float(seconds))
+            if tokens < 1:
+                wait = max(wait, (1 - tokens) * seconds / float(limit))
+            updated[key] = (tokens - 1, now)
+        if wait:
+            return wait
+        if updated:
+            cache.set_many(updated, max(seconds for seconds, limit in buckets.values()))
+        return 0
+
+
+def get_rate_limiter():
+    """
+    Return an instance of the rate limiter named by
+    ``INVITATION_RATE_LIMITER``, or ``None`` if rate limiting is disabled.
+    """
+    path = getattr(settings, 'INVITATION_RATE_LIMITER', DEFAULT_RATE_LIMITER)
+    if path is None:
+        return None
+    return import_from_setting(path, 'invitation rate limiter')()
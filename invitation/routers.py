@@ -0,0 +1,75 @@
+"""
+A database router sending invitation reads to a replica.
+
+Add it to ``DATABASE_ROUTERS`` and name the replica's alias in the
+``INVITATION_REPLICA_DB`` setting::
+
+    DATABASE_ROUTERS = ['invitation.routers.InvitationRouter']
+    INVITATION_REPLICA_DB = 'replica'
+
+Reads of the invitation models -- the accept page lookup, quota counts,
+the invitation form's email check, the admin changelist -- then go to the
+replica, and writes to the ``default`` database. Once anything has been
+written, further reads from the same thread are pinned to ``default``, so
+a request always sees its own writes whatever the replication lag; add
+``invitation.routers.PinningMiddleware`` to ``MIDDLEWARE_CLASSES`` to
+unpin them at the start of each request. Models of other applications are
+left to the other routers.
+
+"""
+
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+_local = threading.local()
+
+
+def pin_to_primary():
+    _local.pinned = True
+
+
+def unpin():
+    _local.pinned = False
+
+
+def is_pinned():
+    return getattr(_local, 'pinned', False)
+
+
+class InvitationRouter(object):
+    def _routed(self, model):
+        return model._meta.app_label == 'invitation'
+
+    def db_for_read(self, model, **hints):
+        if self._routed(model) and not is_pinned():
+            return getattr(settings, 'INVITATION_REPLICA_DB', None)
+        return None
+
+    def db_for_write(self, model, **hints):
+        pin_to_primary()
+        if self._routed(model):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary.
+        databases = (DEFAULT_DB_ALIAS, getattr(settings, 'INVITATION_REPLICA_DB', None))
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class PinningMiddleware(object):
+    """
+    Unpins reads from the primary database at the start and end of each
+    request, so that only reads following a write in the same request are
+    pinned.
+    """
+    def process_request(self, request):
+        unpin()
+
+    def process_response(self, request, response):
+        unpin()
+        return response
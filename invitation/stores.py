@@ -0,0 +1,256 @@
+"""
+Invitation stores.
+
+The ``invite`` and ``invitation_accepted`` views create, look up and
+redeem invitations, and check quotas, through the invitation store named
+by the ``INVITATION_STORE`` setting, a dotted path to a class which
+defaults to ``invitation.stores.ORMInvitationStore``. A store is
+instantiated with no arguments and implements the methods of
+``BaseInvitationStore``.
+
+``ORMInvitationStore`` keeps every invitation in the ``Invitation``
+table. ``CacheInvitationStore`` keeps pending invitations in a cache
+(``INVITATION_STORE_CACHE``, the ``default`` cache unless set), where
+they expire on their own, and only writes an ``Invitation`` row when one
+is accepted. It suits short-lived invitations, e.g. for a promotion,
+which then never need ``cleanupinvitation``.
+
+"""
+
+import datetime
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.utils import timezone
+
+from invitation.codes import generate_codes
+from invitation.models import Invitation, _resolve_groups
+from invitation.utils import import_from_setting
+
+DEFAULT_STORE = 'invitation.stores.ORMInvitationStore'
+
+
+class BaseInvitationStore(object):
+    def create(self, user, email, groups=None):
+        """
+        Create an invitation from ``user`` to ``email``, whose acceptor
+        will join ``groups``, and return it as an ``Invitation``.
+        """
+        raise NotImplementedError
+
+    def lookup(self, code):
+        """
+        Return the ``Invitation`` with the given code, or ``None``.
+        """
+        raise NotImplementedError
+
+    def claim(self, invitation):
+        """
+        Mark ``invitation`` as used, provided it is still unused and has
+        not expired. Returns ``True`` if it was claimed by this call.
+        """
+        raise NotImplementedError
+
+    def accept(self, invitation, user):
+        """
+        Record that the claimed ``invitation`` was accepted by ``user``,
+        and add ``user`` to its groups.
+        """
+        raise NotImplementedError
+
+    def release(self, invitation):
+        """
+        Undo ``claim()`` and ``accept()`` of ``invitation``, after
+        accepting it failed and the view's transaction is rolled back.
+        Stores which only write to the database need do nothing, since
+        the rollback undoes the claim.
+        """
+        pass
+
+    def sent_count(self, user):
+        """
+        Return the number of invitations sent by ``user``.
+        """
+        raise NotImplementedError
+
+    def remaining_invitations(self, user):
+        """
+        Return the number of invitations ``user`` may still send, if
+        ``INVITATIONS_PER_USER`` is set.
+        """
+        if hasattr(settings, 'INVITATIONS_PER_USER'):
+            return max(settings.INVITATIONS_PER_USER - self.sent_count(user), 0)
+
+
+class ORMInvitationStore(BaseInvitationStore):
+    """
+    Keeps invitations in the ``Invitation`` table.
+    """
+    def create(self, user, email, groups=None):
+        return Invitation.objects.create_invitation(user, email, groups=groups)
+
+    def lookup(self, code):
+        return Invitation.objects.lookup(code)
+
+    def claim(self, invitation):
+        return Invitation.objects.claim_invitation(invitation.code)
+
+    def accept(self, invitation, user):
+        # The invitation was marked used by the claim; only record who
+        # used it.
+        invitation.used = True
+        invitation.to_user = user
+        invitation.save(update_fields=['to_user'])
+        # Fetch the invitation's groups once and add them all in bulk.
+        groups = list(invitation.groups.all())
+        if groups:
+            user.groups.add(*groups)
+
+    def sent_count(self, user):
+        return Invitation.objects.sent_count(user)
+
+    def remaining_invitations(self, user):
+        return Invitation.objects.remaining_invitations_for_user(user)
+
+
+class CacheInvitationStore(ORMInvitationStore):
+    """
+    Keeps pending invitations in a cache until they expire, and writes an
+    ``Invitation`` row once one is accepted.
+
+    Invitations created here have no primary key until they are accepted,
+    so they are always emailed at once rather than queued. Inviting an
+    address which already has a pending invitation returns that
+    invitation. ``sent_count()`` counts the invitations a user created
+    through this store on each of the last ``ACCOUNT_INVITATION_DAYS``
+    days, today included, with a counter per day.
+
+    The cache is not rolled back with the database, so the
+    ``invitation_accepted`` view calls ``release()`` when accepting an
+    invitation fails, which puts the claimed entry back.
+    """
+    def __init__(self):
+        self.cache = get_cache(getattr(settings, 'INVITATION_STORE_CACHE', 'default'))
+        # The entries claimed through this store, as they were before.
+        self._claimed = {}
+
+    def _key(self, code):
+        return 'invitation:store:%s' % code
+
+    def _email_key(self, email):
+        return 'invitation:store:email:%s' % email
+
+    def _claimed_key(self, code):
+        return 'invitation:store:claimed:%s' % code
+
+    def _sent_key(self, user_id, day):
+        return 'invitation:store:sent:%s:%d' % (user_id, day)
+
+    def _sent_days(self):
+        today = timezone.now().date().toordinal()
+        return range(today - settings.ACCOUNT_INVITATION_DAYS + 1, today + 1)
+
+    def _timeout(self, entry):
+        return max(int((entry['expiration_date'] - timezone.now()).total_seconds()), 1)
+
+    def _build(self, code, entry, from_user=None):
+        invitation = Invitation(code=code, email=entry['email'],
+                                from_user_id=entry['from_user_id'],
+                                date_invited=entry['date_invited'],
+                                expiration_date=entry['expiration_date'],
+                                used=entry['used'])
+        if from_user is not None:
+            invitation.from_user = from_user
+        return invitation
+
+    def create(self, user, email, groups=None):
+        email = email.strip().lower()
+        code = self.cache.get(self._email_key(email))
+        if code is not None:
+            invitation = self.lookup(code)
+            if invitation is not None and not invitation.used:
+                return invitation
+
+        date_invited = timezone.now()
+        entry = {
+            'email': email,
+            'from_user_id': user.pk,
+            'date_invited': date_invited,
+            'expiration_date': date_invited + datetime.timedelta(settings.ACCOUNT_INVITATION_DAYS),
+            'used': False,
+            'groups': [group.pk for group in _resolve_groups(groups)],
+        }
+        code = generate_codes(user, 1)[0]
+        timeout = self._timeout(entry)
+        self.cache.set_many({self._key(code): entry, self._email_key(email): code}, timeout)
+        # Today's counter is summed by sent_count() until it is
+        # ACCOUNT_INVITATION_DAYS days old.
+        sent_key = self._sent_key(user.pk, self._sent_days()[-1])
+        try:
+            self.cache.incr(sent_key)
+        except ValueError:
+            if not self.cache.add(sent_key, 1, (settings.ACCOUNT_INVITATION_DAYS + 1) * 24 * 60 * 60):
+                self.cache.incr(sent_key)
+        return self._build(code, entry, from_user=user)
+
+    def lookup(self, code):
+        if len(code) > Invitation._meta.get_field('code').max_length:
+            return None
+        entry = self.cache.get(self._key(code))
+        if entry is not None:
+            return self._build(code, entry)
+        # Accepted invitations live in the database.
+        return super(CacheInvitationStore, self).lookup(code)
+
+    def claim(self, invitation):
+        if invitation.pk is not None:
+            return super(CacheInvitationStore, self).claim(invitation)
+        entry = self.cache.get(self._key(invitation.code))
+        if entry is None or entry['used'] or entry['expiration_date'] < timezone.now():
+            return False
+        # add() is atomic, so only one of several racing requests gets to
+        # mark the invitation used.
+        if not self.cache.add(self._claimed_key(invitation.code), True, self._timeout(entry)):
+            return False
+        self._claimed[invitation.code] = dict(entry)
+        entry['used'] = True
+        self.cache.set(self._key(invitation.code), entry, self._timeout(entry))
+        return True
+
+    def accept(self, invitation, user):
+        if invitation.pk is not None:
+            return super(CacheInvitationStore, self).accept(invitation, user)
+        entry = self.cache.get(self._key(invitation.code))
+        invitation.used = True
+        invitation.to_user = user
+        invitation.save()
+        if entry is not None and entry['groups']:
+            user.groups.add(*entry['groups'])
+        self.cache.delete_many([self._key(invitation.code), self._email_key(invitation.email)])
+
+    def release(self, invitation):
+        entry = self._claimed.pop(invitation.code, None)
+        if entry is None:
+            return
+        self.cache.set_many({self._key(invitation.code): entry,
+                             self._email_key(entry['email']): invitation.code},
+                            self._timeout(entry))
+        # Only allow the invitation to be claimed again once its entry is
+        # back.
+        self.cache.delete(self._claimed_key(invitation.code))
+
+    def sent_count(self, user):
+        keys = [self._sent_key(user.pk, day) for day in self._sent_days()]
+        return sum(self.cache.get_many(keys).values())
+
+    def remaining_invitations(self, user):
+        return BaseInvitationStore.remaining_invitations(self, user)
+
+
+def get_store():
+    """
+    Return an instance of the invitation store named by
+    ``INVITATION_STORE``.
+    """
+    path = getattr(settings, 'INVITATION_STORE', DEFAULT_STORE)
+    return import_from_setting(path, 'invitation store')()
@@ -17,18 +17,66 @@ getting django-invitation running in the default setup, to wit:
 """
 
 import datetime
+import json
+import os
 import sha
+import socket
+import tempfile
+import threading
+import time
+from StringIO import StringIO
 
 from django.conf import settings
-from django.contrib.auth.models import User
+from django.contrib import admin
+from django.contrib.admin.util import lookup_field
+from django.contrib.admin.views.main import ChangeList
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import AnonymousUser, Group, User
+from django.contrib.messages.storage import default_storage
+from django.contrib.sites.models import Site
 from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.core import management
+from django.core.mail.backends import locmem
+from django.core.mail.backends.base import BaseEmailBackend
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import IntegrityError, connection, connections, router
+from django.db.models import signals
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client, RequestFactory
+from django.test.utils import override_settings
+from django.utils.unittest import skipUnless
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
+from invitation import background
+from invitation import export
 from invitation import forms
-from invitation.models import Invitation
+from invitation import models
+from invitation import ratelimit
+from invitation import routers
+from invitation import stores
+from invitation.admin import InvitationAdmin
+from invitation.instrumentation import MemorySink, instrumented
+from invitation.mailer import InvitationMailer
+from invitation.models import Invitation, InvitationDelivery, InvitationManager
+
+def count_queries(func):
+    """
+    Call ``func`` and return the number of database queries it made.
+    """
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    try:
+        before = len(connection.queries)
+        func()
+        return len(connection.queries) - before
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+
 
 class InvitationTestCase(TestCase):
     """
@@ -38,12 +86,13 @@ class InvitationTestCase(TestCase):
     
     """
     def setUp(self):
+        cache.clear()
         self.sample_user = User.objects.create_user(username='alice',
                                                     password='secret',
                                                     email='alice@example.com')
         self.sample_invite = Invitation.objects.create_invitation(user=self.sample_user, email='fred@example.com')
         self.expired_invite = Invitation.objects.create_invitation(user=self.sample_user, email='bob@example.com')
-        self.expired_invite.expiration_date = datetime.datetime.now() - datetime.timedelta(1)
+        self.expired_invite.expiration_date = timezone.now() - datetime.timedelta(1)
         self.expired_invite.save()
 
 
@@ -60,6 +109,145 @@ class InvitationModelTests(InvitationTestCase):
         """
         self.assertEqual(Invitation.objects.count(), 2)
 
+    def test_expired(self):
+        """
+        Test that ``expired()`` compares dates with or without time zone
+        support.
+
+        """
+        for use_tz in (True, False):
+            with self.settings(USE_TZ=use_tz):
+                invite = Invitation.objects.create_invitation(user=self.sample_user,
+                                                              email='carol@example.com')
+                invite = Invitation.objects.get(pk=invite.pk)
+                self.failIf(invite.expired())
+                invite.expiration_date -= datetime.timedelta(settings.ACCOUNT_INVITATION_DAYS + 1)
+                self.failUnless(invite.expired())
+                invite.delete()
+
+    def test_status_queries(self):
+        """
+        Test that invitations can be selected and labelled by status in
+        the database.
+
+        """
+        self.assertEqual(list(Invitation.objects.pending()), [self.sample_invite])
+        self.assertEqual(list(Invitation.objects.expired()), [self.expired_invite])
+        self.assertEqual(list(Invitation.objects.used()), [])
+        Invitation.objects.claim_invitation(self.sample_invite.code)
+        self.assertEqual(list(Invitation.objects.used()), [self.sample_invite])
+        self.assertEqual(Invitation.objects.pending().count(), 0)
+        self.assertEqual(dict(Invitation.objects.annotate_status().values_list('email', 'status')),
+                         {'fred@example.com': models.STATUS_USED,
+                          'bob@example.com': models.STATUS_EXPIRED})
+
+    def test_cached_lookup(self):
+        """
+        Test that invitations, and unknown codes, are looked up from the
+        cache until the invitation changes.
+
+        """
+        code, expired_code = self.sample_invite.code, self.expired_invite.code
+        self.assertEqual(Invitation.objects.lookup(code), self.sample_invite)
+        self.assertEqual(Invitation.objects.lookup('unknown'), None)
+        with self.assertNumQueries(0):
+            self.assertEqual(Invitation.objects.lookup(code), self.sample_invite)
+            self.assertEqual(Invitation.objects.lookup('unknown'), None)
+            self.assertEqual(Invitation.objects.lookup('x' * 41), None)
+
+        Invitation.objects.claim_invitation(code)
+        self.failUnless(Invitation.objects.lookup(code).used)
+
+        self.failUnless(Invitation.objects.lookup(expired_code).expired())
+        Invitation.objects.extend_invitations()
+        self.failIf(Invitation.objects.lookup(expired_code).expired())
+        Invitation.objects.filter(code=expired_code).update(expiration_date=timezone.now())
+        Invitation.objects.invalidate_lookups([expired_code])
+        self.failUnless(Invitation.objects.lookup(expired_code).expired())
+        self.expired_invite.extend()
+        self.failIf(Invitation.objects.lookup(expired_code).expired())
+
+        Invitation.objects.get(code=expired_code).delete()
+        self.assertEqual(Invitation.objects.lookup(expired_code), None)
+
+    def test_code_collision(self):
+        """
+        Test that ``create_invitation`` generates a new code when the
+        first one is already taken.
+
+        """
+        codes = iter([self.sample_invite.code, 'f' * 40])
+        original = InvitationManager._generate_code
+        InvitationManager._generate_code = lambda manager, user: next(codes)
+        try:
+            invite = Invitation.objects.create_invitation(user=self.sample_user,
+                                                          email='carol@example.com')
+        finally:
+            InvitationManager._generate_code = original
+        self.assertEqual(invite.code, 'f' * 40)
+        self.assertEqual(Invitation.objects.count(), 3)
+
+    def test_code_generator(self):
+        """
+        Test that invitation codes are short and URL-safe by default, and
+        that the generator can be swapped with
+        ``INVITATION_CODE_GENERATOR``.
+
+        """
+        self.assertEqual(len(self.sample_invite.code), 20)
+        reverse('invitation_accepted', kwargs={'invitation_code': '-_' + 'a' * 18})
+        with self.settings(INVITATION_CODE_GENERATOR='invitation.codes.sha1_codes'):
+            invite = Invitation.objects.create_invitation(user=self.sample_user,
+                                                          email='carol@example.com')
+        self.assertEqual(len(invite.code), 40)
+        int(invite.code, 16)
+
+    def test_extend(self):
+        """
+        Test that ``Invitation.extend()`` renews an expired invitation.
+
+        """
+        self.expired_invite.extend()
+        self.failIf(Invitation.objects.get(pk=self.expired_invite.pk).expired())
+
+    def test_extend_invitations(self):
+        """
+        Test that ``extend_invitations`` renews the matching unused
+        invitations in chunks, optionally sending them again.
+
+        """
+        for n in range(3):
+            invite = Invitation.objects.create_invitation(user=self.sample_user,
+                                                          email='old%d@example.org' % n)
+            invite.expiration_date = timezone.now() - datetime.timedelta(1)
+            invite.save()
+        Invitation.objects.filter(email='old0@example.org').update(used=True)
+
+        progress = []
+        queryset = Invitation.objects.filter(email__endswith='@example.org')
+        mailer = InvitationMailer(message_template=Template(
+            '{{ invitation.expiration_date|date:"Y-m-d" }}'))
+        self.assertEqual(Invitation.objects.extend_invitations(queryset, days=5, resend=True,
+                                                               batch_size=1,
+                                                               progress=progress.append,
+                                                               mailer=mailer), 2)
+        self.assertEqual(progress, [1, 2])
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         ['old1@example.org', 'old2@example.org'])
+        # The emails show the new expiration date.
+        expiration_date = Invitation.objects.get(email='old1@example.org').expiration_date
+        self.assertEqual(set(m.body for m in mail.outbox),
+                         set([Template('{{ date|date:"Y-m-d" }}').render(
+                             Context({'date': expiration_date}))]))
+        self.assertEqual(Invitation.objects.filter(expiration_date__lt=timezone.now())
+                                           .count(), 2)
+
+        out = StringIO()
+        management.call_command('extendinvitations', inviter='alice', domain='example.com',
+                                stdout=out)
+        self.failUnless('Extended 2 invitations' in out.getvalue())
+        self.failIf(Invitation.objects.get(pk=self.expired_invite.pk).expired())
+
     def test_activation_email(self):
         """
         Test that user signup sends an activation email.
@@ -84,9 +272,252 @@ class InvitationModelTests(InvitationTestCase):
         correctly.
         
         """
-        management.call_command('cleanupinvitation')
+        management.call_command('cleanupinvitation', stdout=StringIO())
         self.assertEqual(Invitation.objects.count(), 1)
 
+    def test_chunked_deletion(self):
+        """
+        Test that ``cleanupinvitation`` deletes in batches, honours
+        ``--limit`` and only counts with ``--dry-run``.
+
+        """
+        past = timezone.now() - datetime.timedelta(1)
+        for n in range(4):
+            invite = Invitation.objects.create_invitation(user=self.sample_user,
+                                                          email='old%d@example.com' % n)
+            invite.expiration_date = past
+            invite.save()
+
+        out = StringIO()
+        management.call_command('cleanupinvitation', dry_run=True, stdout=out)
+        self.failUnless('5 expired invitations would be deleted' in out.getvalue())
+        self.assertEqual(Invitation.objects.count(), 6)
+
+        progress = []
+        self.assertEqual(Invitation.objects.delete_expired_invitations(batch_size=2, limit=3,
+                                                                       progress=progress.append), 3)
+        self.assertEqual(progress, [2, 3])
+        self.assertEqual(Invitation.objects.count(), 3)
+
+        management.call_command('cleanupinvitation', batch_size=1, stdout=StringIO())
+        self.assertEqual(list(Invitation.objects.all()), [self.sample_invite])
+
+
+class InvitationMailerTests(InvitationTestCase):
+    """
+    Tests for ``InvitationMailer``.
+
+    """
+    def test_send_many(self):
+        """
+        Test that a mailer fetches the site once for any number of emails,
+        and accepts per-call templates.
+
+        """
+        Site.objects.clear_cache()
+        mailer = InvitationMailer(from_email='invites@example.com')
+        with self.assertNumQueries(1):
+            self.assertEqual(mailer.send([self.sample_invite, self.expired_invite]), 2)
+        self.assertEqual([m.to for m in mail.outbox],
+                         [['fred@example.com'], ['bob@example.com']])
+        self.failUnless(self.sample_invite.code in mail.outbox[0].body)
+        self.assertEqual(mail.outbox[0].from_email, 'invites@example.com')
+
+        subject, message, from_email, recipients = mailer.render(
+            self.sample_invite, message_template=Template('Hello {{ invitation.email }}'))
+        self.assertEqual(message, 'Hello fred@example.com')
+
+
+class InvitationBulkTests(InvitationTestCase):
+    """
+    Tests for bulk invitation creation and the ``bulkinvite`` command.
+
+    """
+    def test_create_invitations_bulk(self):
+        """
+        Test that ``create_invitations_bulk`` skips duplicate, invalid,
+        already invited and already registered addresses, and sends one
+        email per new invitation.
+
+        """
+        emails = ['carol@example.com', 'Carol@Example.com', 'not-an-email',
+                  'FRED@example.com', 'alice@example.com', 'dave@example.com']
+        results = Invitation.objects.create_invitations_bulk(self.sample_user, emails,
+                                                              batch_size=2)
+        self.assertEqual(results, [
+            ('carol@example.com', models.BULK_INVITED),
+            ('carol@example.com', models.BULK_DUPLICATE),
+            ('not-an-email', models.BULK_INVALID),
+            ('fred@example.com', models.BULK_ALREADY_INVITED),
+            ('alice@example.com', models.BULK_ALREADY_REGISTERED),
+            ('dave@example.com', models.BULK_INVITED),
+        ])
+        self.assertEqual(Invitation.objects.count(), 4)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         ['carol@example.com', 'dave@example.com'])
+
+    def test_large_batch(self):
+        """
+        Test that batches larger than SQLite's limit on query parameters
+        are checked and written.
+
+        """
+        User.objects.create_user('member0', 'Member0@Example.com', 'secret')
+        emails = ['member%d@example.com' % n for n in range(1500)] + ['fred@example.com']
+        results = Invitation.objects.create_invitations_bulk(self.sample_user, emails,
+                                                              batch_size=2000, send=False)
+        self.assertEqual(results[0], ('member0@example.com', models.BULK_ALREADY_REGISTERED))
+        self.assertEqual(results[-1], ('fred@example.com', models.BULK_ALREADY_INVITED))
+        self.assertEqual(Invitation.objects.count(), 1501)
+
+    def test_groups(self):
+        """
+        Test that invitations are added to their groups with a number of
+        queries which does not depend on the number of invitations.
+
+        """
+        team = Group.objects.create(name='team')
+        staff = Group.objects.create(name='staff')
+        emails = ['member%d@example.com' % n for n in range(6)]
+        small = count_queries(lambda: Invitation.objects.create_invitations_bulk(
+            self.sample_user, emails[:2], send=False, groups=['team', staff]))
+        large = count_queries(lambda: Invitation.objects.create_invitations_bulk(
+            self.sample_user, emails[2:], send=False, groups=['team', staff]))
+        self.assertEqual(small, large)
+        for invitation in Invitation.objects.filter(email__in=emails):
+            self.assertEqual(set(invitation.groups.all()), set([team, staff]))
+
+        invitation = Invitation.objects.create_invitation(self.sample_user, 'carol@example.com',
+                                                          groups=['team'])
+        self.assertEqual(list(invitation.groups.all()), [team])
+        self.assertRaises(Group.DoesNotExist, Invitation.objects.create_invitation,
+                          self.sample_user, 'dave@example.com', groups=['nobody'])
+
+    def test_bulkinvite_command(self):
+        """
+        Test that ``manage.py bulkinvite`` reads addresses from a CSV file
+        and reports a result for each of them.
+
+        """
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.write(fd, 'email,name\ncarol@example.com,Carol\nfred@example.com,Fred\n')
+        os.close(fd)
+        out = StringIO()
+        try:
+            management.call_command('bulkinvite', 'alice', path, stdout=out)
+        finally:
+            os.remove(path)
+        self.assertEqual(Invitation.objects.count(), 3)
+        self.assertEqual(len(mail.outbox), 1)
+        output = out.getvalue()
+        self.failUnless('carol@example.com\tinvited' in output)
+        self.failUnless('fred@example.com\talready invited' in output)
+        self.failUnless('Processed 2 addresses' in output)
+
+    def test_bulkinvite_stream(self):
+        """
+        Test that ``bulkinvite`` reports values which are not addresses as
+        invalid, and repeated addresses as duplicates across batches.
+
+        """
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.write(fd, 'email\ncarol@example.com\nCarol\n\ncarol@example.com\n')
+        os.close(fd)
+        out = StringIO()
+        try:
+            management.call_command('bulkinvite', 'alice', path, batch_size=1, stdout=out)
+        finally:
+            os.remove(path)
+        self.assertEqual(out.getvalue().splitlines()[:3],
+                         ['carol@example.com\tinvited', 'carol\tinvalid',
+                          'carol@example.com\tduplicate'])
+        self.assertEqual(Invitation.objects.count(), 3)
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class FailingEmailBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        raise socket.error("relay unavailable")
+
+
+class SlowEmailBackend(locmem.EmailBackend):
+    def send_messages(self, email_messages):
+        time.sleep(0.2)
+        return super(SlowEmailBackend, self).send_messages(email_messages)
+
+
+class InvitationDeliveryTests(InvitationTestCase):
+    """
+    Tests for the invitation email outbox and the ``sendinvitations``
+    command.
+
+    """
+    @override_settings(INVITATION_QUEUE_EMAILS=True)
+    def test_queued_delivery(self):
+        """
+        Test that a queued invitation is only emailed by
+        ``manage.py sendinvitations``, which records its delivery.
+
+        """
+        self.sample_invite.send()
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(InvitationDelivery.objects.count(), 1)
+        self.assertEqual(Invitation.objects.get(pk=self.sample_invite.pk).delivery_status,
+                         models.DELIVERY_QUEUED)
+
+        management.call_command('sendinvitations', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['fred@example.com'])
+        self.assertEqual(InvitationDelivery.objects.count(), 0)
+        self.assertEqual(Invitation.objects.get(pk=self.sample_invite.pk).delivery_status,
+                         models.DELIVERY_SENT)
+
+    @override_settings(INVITATION_DELIVERY_MAX_ATTEMPTS=2)
+    def test_failed_delivery(self):
+        """
+        Test that a failed email is retried later, and the invitation is
+        marked as failed once it runs out of attempts.
+
+        """
+        self.sample_invite.send(queue=True)
+        self.assertEqual(InvitationDelivery.objects.deliver_pending(connection=FailingEmailBackend()),
+                         (0, 1, 0))
+        delivery = InvitationDelivery.objects.get()
+        self.assertEqual(delivery.attempts, 1)
+        self.failUnless(delivery.last_error)
+        # Not due yet, so nothing is attempted.
+        self.assertEqual(InvitationDelivery.objects.deliver_pending(connection=FailingEmailBackend()),
+                         (0, 0, 0))
+
+        InvitationDelivery.objects.update(next_attempt=delivery.next_attempt - datetime.timedelta(days=1))
+        self.assertEqual(InvitationDelivery.objects.deliver_pending(connection=FailingEmailBackend()),
+                         (0, 0, 1))
+        self.assertEqual(InvitationDelivery.objects.count(), 0)
+        self.assertEqual(Invitation.objects.get(pk=self.sample_invite.pk).delivery_status,
+                         models.DELIVERY_FAILED)
+
+
+    def test_overlapping_runs(self):
+        """
+        Test that a run which starts while another is sending does not
+        send the same emails again.
+
+        """
+        self.sample_invite.send(queue=True)
+        self.expired_invite.send(queue=True)
+        overlapping = []
+
+        class OverlappingEmailBackend(locmem.EmailBackend):
+            def send_messages(self, email_messages):
+                overlapping.append(InvitationDelivery.objects.deliver_pending())
+                return super(OverlappingEmailBackend, self).send_messages(email_messages)
+
+        self.assertEqual(InvitationDelivery.objects.deliver_pending(
+            connection=OverlappingEmailBackend()), (2, 0, 0))
+        self.assertEqual(overlapping, [(0, 0, 0), (0, 0, 0)])
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         ['bob@example.com', 'fred@example.com'])
+
 
 class InvitationFormTests(InvitationTestCase):
     """
@@ -117,6 +548,30 @@ class InvitationFormTests(InvitationTestCase):
             field, error_msg = invalid_dict['error']
             self.assertFormError(response, 'form', field, error_msg)
 
+    def test_email_check_queries(self):
+        """
+        Test that ``InvitationForm`` checks an address with at most two
+        indexed queries.
+
+        """
+        with self.assertNumQueries(1):
+            self.failIf(forms.InvitationForm(data={'email': 'Fred@Example.com'}).is_valid())
+        with self.assertNumQueries(2):
+            self.failUnless(forms.InvitationForm(data={'email': 'carol@example.com'}).is_valid())
+
+    def test_email_normalized(self):
+        """
+        Test that invitation addresses are stored lowercased.
+
+        """
+        invite = Invitation.objects.create_invitation(user=self.sample_user,
+                                                      email=' Carol@Example.COM')
+        self.assertEqual(Invitation.objects.get(pk=invite.pk).email, 'carol@example.com')
+        self.assertEqual(Invitation.objects.unavailable_emails(['carol@example.com',
+                                                                'alice@example.com',
+                                                                'dave@example.com']),
+                         (set(['carol@example.com']), set(['alice@example.com'])))
+
 
 class InvitationViewTests(InvitationTestCase):
     """
@@ -175,6 +630,816 @@ class InvitationViewTests(InvitationTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, 'invitation/invalid.html')
 
+    def test_accept_groups(self):
+        """
+        Test that accepting an invitation adds the new user to its groups.
+
+        """
+        team = Group.objects.create(name='team')
+        invite = Invitation.objects.create_invitation(self.sample_user, 'carol@example.com',
+                                                      groups=[team])
+        response = self.client.post(reverse('invitation_accepted',
+                                            kwargs={'invitation_code': invite.code}),
+                                    data={'username': 'carol', 'password1': 'secret',
+                                          'password2': 'secret'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(list(User.objects.get(username='carol').groups.all()), [team])
+
+    def test_used_invitation(self):
+        """
+        Test that an invitation can only be accepted once.
+
+        """
+        url = reverse('invitation_accepted',
+                      kwargs={'invitation_code': self.sample_invite.code})
+        data = {'username': 'fred', 'password1': 'secret', 'password2': 'secret'}
+        response = self.client.post(url, data=data)
+        self.assertEqual(response.status_code, 302)
+        invite = Invitation.objects.get(pk=self.sample_invite.pk)
+        self.failUnless(invite.used)
+        self.assertEqual(invite.to_user.username, 'fred')
+        # The new user is logged in without being authenticated again.
+        self.assertEqual(self.client.session['_auth_user_id'], invite.to_user.pk)
+        self.assertEqual(self.client.session['_auth_user_backend'],
+                         'django.contrib.auth.backends.ModelBackend')
+
+        self.client.logout()
+        response = self.client.get(url)
+        self.assertTemplateUsed(response, 'invitation/invalid.html')
+        data['username'] = 'fred2'
+        response = self.client.post(url, data=data)
+        self.assertTemplateUsed(response, 'invitation/invalid.html')
+        self.assertEqual(User.objects.filter(email='fred@example.com').count(), 1)
+
+    def test_login_backend(self):
+        """
+        Test that the new user is logged in with the first backend which
+        checks passwords, whatever backends come before it.
+
+        """
+        url = reverse('invitation_accepted',
+                      kwargs={'invitation_code': self.sample_invite.code})
+        data = {'username': 'fred', 'password1': 'secret', 'password2': 'secret'}
+        backends = ('invitation.tests.RemoteUserBackend',
+                    'invitation.tests.SubclassedModelBackend')
+        with self.settings(AUTHENTICATION_BACKENDS=backends):
+            response = self.client.post(url, data=data)
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(self.client.session['_auth_user_backend'],
+                             'invitation.tests.SubclassedModelBackend')
+            # The user stays logged in on the next request.
+            response = self.client.get(reverse('invitation_invite'))
+            self.assertEqual(response.status_code, 200)
+
+
+class RemoteUserBackend(object):
+    """
+    An authentication backend which does not check passwords.
+
+    """
+    def authenticate(self, username=None):
+        return None
+
+    def get_user(self, user_id):
+        return None
+
+
+class SubclassedModelBackend(ModelBackend):
+    pass
+
+
+class InvitationRateLimitTests(InvitationTestCase):
+    """
+    Tests for the rate limiting of the invite view.
+
+    """
+    def test_fixed_window(self):
+        """
+        Test that requests are counted per user and per IP address in each
+        window, and that refused requests are not counted.
+
+        """
+        limiter = ratelimit.FixedWindowRateLimiter({'minute': 2, 'day': 3},
+                                                   get_ip=ratelimit.remote_addr)
+        limiter.now = lambda: 1000.0
+        request = RequestFactory().post('/invite/', REMOTE_ADDR='10.0.0.1')
+        request.user = self.sample_user
+        self.assertEqual(limiter.throttle(request), 0)
+        self.assertEqual(limiter.throttle(request), 0)
+        # The minute window started at 960.
+        self.assertEqual(limiter.throttle(request), 20)
+        self.assertEqual(limiter.throttle(request), 20)
+
+        # Another user is still limited by IP address, but not from another one.
+        request.user = User.objects.create_user('carol', 'carol@example.com', 'secret')
+        self.failUnless(limiter.throttle(request))
+        request.META['REMOTE_ADDR'] = '10.0.0.2'
+        self.assertEqual(limiter.throttle(request), 0)
+
+        # The refused requests did not use up the day's third invitation.
+        limiter.now = lambda: 1030.0
+        request.user = self.sample_user
+        request.META['REMOTE_ADDR'] = '10.0.0.1'
+        self.assertEqual(limiter.throttle(request), 0)
+        self.assertEqual(limiter.throttle(request), 86400 - 1030)
+
+    def test_token_bucket(self):
+        """
+        Test that buckets are kept per user and per IP address, and refill
+        over time.
+
+        """
+        limiter = ratelimit.TokenBucketRateLimiter({'minute': 2}, get_ip=ratelimit.remote_addr)
+        limiter.now = lambda: 1000.0
+        request = RequestFactory().post('/invite/', REMOTE_ADDR='10.0.0.1')
+        request.user = self.sample_user
+        self.assertEqual(limiter.throttle(request), 0)
+        self.assertEqual(limiter.throttle(request), 0)
+        self.assertEqual(limiter.throttle(request), 30)
+
+        # Another user is still limited by IP address, but not from another one.
+        request.user = User.objects.create_user('carol', 'carol@example.com', 'secret')
+        self.failUnless(limiter.throttle(request))
+        request.META['REMOTE_ADDR'] = '10.0.0.2'
+        self.assertEqual(limiter.throttle(request), 0)
+
+        limiter.now = lambda: 1030.0
+        request.user = self.sample_user
+        request.META['REMOTE_ADDR'] = '10.0.0.1'
+        self.assertEqual(limiter.throttle(request), 0)
+        self.failUnless(limiter.throttle(request))
+
+    def test_invite_throttled(self):
+        """
+        Test that the invite view answers 429 once the limit is reached.
+
+        """
+        self.client.login(username='alice', password='secret')
+        with self.settings(INVITATION_RATE_LIMITER='invitation.ratelimit.FixedWindowRateLimiter',
+                           INVITATION_RATE_LIMITS={'minute': 2, 'day': 10}):
+            for n in range(2):
+                response = self.client.post(reverse('invitation_invite'),
+                                            data={'email': 'rate%d@example.com' % n})
+                self.assertEqual(response.status_code, 302)
+            response = self.client.post(reverse('invitation_invite'),
+                                        data={'email': 'rate2@example.com'})
+            self.assertEqual(response.status_code, 429)
+            self.failUnless(1 <= int(response['Retry-After']) <= 60)
+            self.assertTemplateUsed(response, 'invitation/invalid.html')
+            # Showing the form is not limited.
+            self.assertEqual(self.client.get(reverse('invitation_invite')).status_code, 200)
+        self.assertEqual(Invitation.objects.count(), 4)
+
+        # Rate limiting is off by default.
+        response = self.client.post(reverse('invitation_invite'),
+                                    data={'email': 'rate2@example.com'})
+        self.assertEqual(response.status_code, 302)
+
+    def test_ip_limits(self):
+        """
+        Test that IP addresses are only limited when
+        ``INVITATION_RATE_LIMIT_IP`` says how to find them.
+
+        """
+        request = RequestFactory().post('/invite/', REMOTE_ADDR='10.0.0.1')
+        request.user = AnonymousUser()
+        limiter = ratelimit.FixedWindowRateLimiter({'minute': 1})
+        self.assertEqual(limiter.get_idents(request), [])
+        self.assertEqual(limiter.throttle(request), 0)
+        self.assertEqual(limiter.throttle(request), 0)
+
+        with self.settings(INVITATION_RATE_LIMIT_IP='invitation.tests.forwarded_for'):
+            limiter = ratelimit.FixedWindowRateLimiter({'minute': 1})
+        request.META['HTTP_X_FORWARDED_FOR'] = '192.0.2.7'
+        self.assertEqual(limiter.get_idents(request), ['ip:192.0.2.7'])
+        self.assertEqual(limiter.throttle(request), 0)
+        self.failUnless(limiter.throttle(request))
+
+
+def forwarded_for(request):
+    return request.META.get('HTTP_X_FORWARDED_FOR')
+
+
+@override_settings(INVITATION_STORE='invitation.stores.CacheInvitationStore')
+class InvitationStoreTests(InvitationTestCase):
+    """
+    Tests for ``CacheInvitationStore``, on the locmem cache.
+
+    """
+    def test_cache_store(self):
+        """
+        Test that pending invitations are kept in the cache and only
+        written to the database when accepted.
+
+        """
+        self.client.login(username='alice', password='secret')
+        response = self.client.post(reverse('invitation_invite'),
+                                    data={'email': 'Carol@example.com'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Invitation.objects.count(), 2)
+        self.assertEqual(len(mail.outbox), 1)
+        store = stores.get_store()
+        self.assertEqual(store.sent_count(self.sample_user), 1)
+        invite = store.create(self.sample_user, 'carol@example.com')
+        self.failUnless(invite.code in mail.outbox[0].body)
+        self.assertEqual(store.sent_count(self.sample_user), 1)
+        self.client.logout()
+
+        url = reverse('invitation_accepted', kwargs={'invitation_code': invite.code})
+        response = self.client.get(url)
+        self.assertTemplateUsed(response, 'invitation/accepted.html')
+        response = self.client.post(url, data={'username': 'carol', 'password1': 'secret',
+                                               'password2': 'secret'})
+        self.assertEqual(response.status_code, 302)
+        accepted = Invitation.objects.get(code=invite.code)
+        self.failUnless(accepted.used)
+        self.assertEqual(accepted.to_user.username, 'carol')
+        self.assertEqual(accepted.email, 'carol@example.com')
+
+        self.client.logout()
+        response = self.client.get(url)
+        self.assertTemplateUsed(response, 'invitation/invalid.html')
+
+    def test_claim_once(self):
+        """
+        Test that a cached invitation can only be claimed once, and that
+        its groups are applied on acceptance.
+
+        """
+        team = Group.objects.create(name='team')
+        store = stores.get_store()
+        invite = store.create(self.sample_user, 'carol@example.com', groups=['team'])
+        self.failUnless(store.claim(store.lookup(invite.code)))
+        self.failIf(store.claim(store.lookup(invite.code)))
+        self.failUnless(store.lookup(invite.code).used)
+
+        user = User.objects.create_user('carol', 'carol@example.com', 'secret')
+        store.accept(store.lookup(invite.code), user)
+        self.assertEqual(list(user.groups.all()), [team])
+        self.assertEqual(store.lookup(invite.code).to_user, user)
+
+    def test_release(self):
+        """
+        Test that releasing a claimed, or even accepted, invitation makes
+        it pending again.
+
+        """
+        store = stores.get_store()
+        invite = store.create(self.sample_user, 'carol@example.com')
+        self.failUnless(store.claim(store.lookup(invite.code)))
+        user = User.objects.create_user('carol', 'carol@example.com', 'secret')
+        store.accept(invite, user)
+        store.release(invite)
+        released = store.lookup(invite.code)
+        self.failIf(released.used)
+        self.assertEqual(released.pk, None)
+        self.assertEqual(store.create(self.sample_user, 'carol@example.com').code, invite.code)
+        self.failUnless(store.claim(released))
+
+    def test_failed_accept(self):
+        """
+        Test that an invitation can still be accepted after creating the
+        account failed.
+
+        """
+        store = stores.get_store()
+        invite = store.create(self.sample_user, 'carol@example.com')
+        url = reverse('invitation_accepted', kwargs={'invitation_code': invite.code})
+        data = {'username': 'carol', 'password1': 'secret', 'password2': 'secret'}
+
+        def fail(sender, **kwargs):
+            raise IntegrityError("column username is not unique")
+        signals.pre_save.connect(fail, sender=User)
+        try:
+            self.assertRaises(IntegrityError, self.client.post, url, data=data)
+        finally:
+            signals.pre_save.disconnect(fail, sender=User)
+        self.failIf(store.lookup(invite.code).used)
+
+        response = self.client.post(url, data=data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Invitation.objects.get(code=invite.code).to_user.username, 'carol')
+
+    def test_sent_count(self):
+        """
+        Test that the sent count covers the last ``ACCOUNT_INVITATION_DAYS``
+        days.
+
+        """
+        store = stores.get_store()
+        store.create(self.sample_user, 'carol@example.com')
+        days = store._sent_days()
+        self.assertEqual(len(days), settings.ACCOUNT_INVITATION_DAYS)
+        store.cache.set(store._sent_key(self.sample_user.pk, days[0]), 2)
+        store.cache.set(store._sent_key(self.sample_user.pk, days[0] - 1), 5)
+        self.assertEqual(store.sent_count(self.sample_user), 3)
+
+    def test_unknown_store(self):
+        """
+        Test that a store which cannot be imported is reported as a
+        configuration error.
+
+        """
+        for path in ('invitation.stores.MissingStore', 'invitation.missing.Store'):
+            with self.settings(INVITATION_STORE=path):
+                self.assertRaises(ImproperlyConfigured, stores.get_store)
+
+
+@override_settings(INVITATION_SEND_IN_BACKGROUND=True,
+                   EMAIL_BACKEND='invitation.tests.SlowEmailBackend')
+class InvitationBackgroundTests(InvitationTestCase):
+    """
+    Tests for sending invitation emails from the background worker pool.
+
+    """
+    @override_settings(EMAIL_BACKEND='invitation.tests.FailingEmailBackend')
+    def test_failed_send_is_queued(self):
+        """
+        Test that an email which fails to send from the background is
+        queued in the outbox instead.
+
+        """
+        mailer = InvitationMailer()
+        models._send_in_background(self.sample_invite, mailer)
+        delivery = InvitationDelivery.objects.get()
+        self.assertEqual(delivery.invitation, self.sample_invite)
+        self.assertEqual(Invitation.objects.get(pk=self.sample_invite.pk).delivery_status,
+                         models.DELIVERY_QUEUED)
+
+        with self.settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            self.assertEqual(InvitationDelivery.objects.deliver_pending(), (1, 0, 0))
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_send_after_commit(self):
+        """
+        Test that emails sent during a request are only handed to the
+        workers after the response, and dropped if the view raises.
+
+        """
+        middleware = background.DeferredJobsMiddleware()
+        request = RequestFactory().get('/')
+        middleware.process_request(request)
+        self.sample_invite.send()
+        background.get_pool().join()
+        self.assertEqual(mail.outbox, [])
+        middleware.process_response(request, HttpResponse())
+        background.get_pool().join()
+        self.assertEqual([m.to for m in mail.outbox], [['fred@example.com']])
+
+        middleware.process_request(request)
+        self.sample_invite.send()
+        middleware.process_exception(request, IntegrityError())
+        middleware.process_response(request, HttpResponse(status=500))
+        background.get_pool().join()
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_bounded_queue(self):
+        """
+        Test that jobs run in the submitting thread once the queue is full.
+
+        """
+        pool = background.WorkerPool(workers=1, queue_size=1)
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+        blocked = pool.submit(block)
+        started.wait(5)
+        queued = pool.submit(threading.current_thread)
+        inline = pool.submit(threading.current_thread)
+        self.failUnless(inline.wait(0))
+        self.assertEqual(inline.get(), threading.current_thread())
+        release.set()
+        pool.join()
+        self.failUnless(blocked.wait(0))
+        self.failIf(queued.get() is threading.current_thread())
+
+
+def _shared_memory_db(alias):
+    settings_dict = connections[alias].settings_dict
+    return (settings_dict['ENGINE'].rsplit('.', 1)[-1] in ('sqlite3', 'spatialite')
+            and settings_dict['TEST_NAME'] in (None, '', ':memory:'))
+
+
+@skipUnless(not _shared_memory_db('default'),
+            "an in-memory SQLite database can only be used by one connection at a time; "
+            "set TEST_NAME to test against a database file")
+class InvitationConcurrencyTests(TransactionTestCase):
+    """
+    Tests of simultaneous requests, each thread using its own database
+    connection.
+
+    """
+    threads = 10
+
+    def run_concurrently(self, func):
+        """
+        Call ``func`` from ``threads`` threads at once, and return the
+        results and the exceptions raised.
+
+        """
+        start = threading.Event()
+        results = []
+        errors = []
+
+        def run():
+            start.wait()
+            try:
+                results.append(func())
+            except Exception as e:
+                errors.append(e)
+            finally:
+                for conn in connections.all():
+                    conn.close()
+
+        workers = [threading.Thread(target=run) for i in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        start.set()
+        for worker in workers:
+            worker.join()
+        return results, errors
+
+    def test_concurrent_claims(self):
+        """
+        Test that exactly one of several simultaneous
+        ``claim_invitation`` calls claims the invitation.
+
+        """
+        user = User.objects.create_user(username='alice', password='secret',
+                                        email='alice@example.com')
+        invite = Invitation.objects.create_invitation(user=user, email='fred@example.com')
+
+        results, errors = self.run_concurrently(
+            lambda: Invitation.objects.claim_invitation(invite.code))
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), self.threads)
+        self.assertEqual(results.count(True), 1)
+        self.failUnless(Invitation.objects.get(pk=invite.pk).used)
+
+    @override_settings(INVITATION_SEND_IN_BACKGROUND=True, INVITATION_RATE_LIMITER=None,
+                       EMAIL_BACKEND='invitation.tests.SlowEmailBackend')
+    def test_invite_does_not_wait_for_smtp(self):
+        """
+        Test that simultaneous invite requests return without waiting for
+        the mail server, and that every email is sent in the end.
+
+        """
+        User.objects.create_user(username='alice', password='secret',
+                                 email='alice@example.com')
+        # Log in beforehand, so that only the requests themselves are timed.
+        requests = []
+        for n in range(self.threads):
+            client = Client()
+            client.login(username='alice', password='secret')
+            requests.append((client, 'guest%d@example.com' % n))
+        lock = threading.Lock()
+
+        def invite():
+            with lock:
+                client, email = requests.pop()
+            return client.post(reverse('invitation_invite'), data={'email': email}).status_code
+
+        started = time.time()
+        results, errors = self.run_concurrently(invite)
+        elapsed = time.time() - started
+        background.get_pool().join()
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [302] * self.threads)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         sorted('guest%d@example.com' % n for n in range(self.threads)))
+        # Sending the emails one after the other takes at least 2 seconds.
+        self.failUnless(elapsed < 2, elapsed)
+
+
+@skipUnless('replica' in settings.DATABASES, "needs a second database named 'replica'")
+@override_settings(INVITATION_REPLICA_DB='replica')
+class InvitationRouterTests(InvitationTestCase):
+    """
+    Tests for ``InvitationRouter``. Nothing is replicated to the replica
+    here, so reads routed to it find no invitations.
+
+    """
+    multi_db = True
+
+    def setUp(self):
+        super(InvitationRouterTests, self).setUp()
+        self.saved_routers = router.routers
+        router.routers = [routers.InvitationRouter()]
+        routers.unpin()
+
+    def tearDown(self):
+        router.routers = self.saved_routers
+        routers.unpin()
+        super(InvitationRouterTests, self).tearDown()
+
+    def test_read_write_split(self):
+        """
+        Test that reads go to the replica until something is written.
+
+        """
+        self.assertEqual(Invitation.objects.count(), 0)
+        self.assertEqual(Invitation.objects.using('default').count(), 2)
+        Invitation.objects.create_invitation(self.sample_user, 'carol@example.com')
+        self.failUnless(routers.is_pinned())
+        self.assertEqual(Invitation.objects.count(), 3)
+        self.assertEqual(Invitation.objects.using('replica').count(), 0)
+
+        routers.PinningMiddleware().process_request(RequestFactory().get('/'))
+        self.assertEqual(Invitation.objects.count(), 0)
+
+    def test_write_paths(self):
+        """
+        Test that the checks made before writing read the primary.
+
+        """
+        results = Invitation.objects.create_invitations_bulk(
+            self.sample_user, ['fred@example.com', 'dave@example.com'], send=False)
+        self.assertEqual(results, [('fred@example.com', models.BULK_ALREADY_INVITED),
+                                   ('dave@example.com', models.BULK_INVITED)])
+        routers.unpin()
+        self.assertEqual(Invitation.objects.delete_expired_invitations(), 1)
+        self.assertEqual(Invitation.objects.using('default').count(), 2)
+
+
+class CountingCache(object):
+    """
+    Records the names of the methods called on ``cache``.
+
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self.calls = []
+
+    def __getattr__(self, name):
+        self.calls.append(name)
+        return getattr(self.cache, name)
+
+
+class InvitationQuotaTests(InvitationTestCase):
+    """
+    Tests for the cached count of invitations sent by each user.
+
+    """
+    def test_cached_sent_count(self):
+        """
+        Test that the sent count is only read from the database once and
+        is kept up to date as invitations are created and deleted.
+
+        """
+        self.assertEqual(Invitation.objects.sent_count(self.sample_user), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(Invitation.objects.sent_count(self.sample_user), 2)
+
+        Invitation.objects.create_invitation(user=self.sample_user, email='carol@example.com')
+        Invitation.objects.create_invitations_bulk(self.sample_user, ['dave@example.com'],
+                                                   send=False)
+        self.expired_invite.delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(Invitation.objects.sent_count(self.sample_user), 3)
+
+    def test_purge(self):
+        """
+        Test that purging expired invitations adjusts the cached counts
+        and lookups once per inviter and chunk rather than once per row,
+        and deletes the invitations' outbox rows and group links.
+
+        """
+        other = User.objects.create_user(username='bob', password='secret',
+                                         email='bob2@example.com')
+        Group.objects.create(name='team')
+        past = timezone.now() - datetime.timedelta(1)
+        for user, n in [(self.sample_user, n) for n in range(3)] + [(other, 3)]:
+            invite = Invitation.objects.create_invitation(user=user, groups=['team'],
+                                                          email='old%d@example.com' % n)
+            invite.expiration_date = past
+            invite.save()
+            invite.send(queue=True)
+        self.assertEqual(Invitation.objects.sent_count(self.sample_user), 5)
+        self.assertEqual(Invitation.objects.sent_count(other), 1)
+        self.failUnless(Invitation.objects.lookup(self.expired_invite.code))
+
+        counting = CountingCache(cache)
+        models.cache = counting
+        try:
+            self.assertEqual(Invitation.objects.delete_expired_invitations(), 5)
+        finally:
+            models.cache = cache
+        self.assertEqual(sorted(counting.calls), ['incr', 'incr', 'set'])
+        self.assertEqual(Invitation.objects.sent_count(self.sample_user), 1)
+        self.assertEqual(Invitation.objects.sent_count(other), 0)
+        self.assertEqual(Invitation.objects.lookup(self.expired_invite.code), None)
+        self.assertEqual(InvitationDelivery.objects.count(), 0)
+        self.assertEqual(Invitation.groups.through.objects.count(), 0)
+
+    def test_reconcile_command(self):
+        """
+        Test that ``manage.py reconcileinvitationquota`` repairs stale
+        cached counts.
+
+        """
+        other = User.objects.create_user(username='bob', password='secret',
+                                         email='bob2@example.com')
+        cache.set(models._sent_count_key(self.sample_user.pk), 99)
+        cache.set(models._sent_count_key(other.pk), 5)
+        management.call_command('reconcileinvitationquota', stdout=StringIO())
+        self.assertEqual(Invitation.objects.sent_count(self.sample_user), 2)
+        self.assertEqual(Invitation.objects.sent_count(other), 0)
+
+
+class InvitationAdminTests(InvitationTestCase):
+    """
+    Tests for the ``Invitation`` admin.
+
+    """
+    def setUp(self):
+        super(InvitationAdminTests, self).setUp()
+        self.admin_user = User.objects.create_superuser(username='admin', password='secret',
+                                                        email='admin@example.com')
+        for n in range(10):
+            Invitation.objects.create_invitation(user=self.admin_user if n % 2 else self.sample_user,
+                                                 email='guest%d@example.com' % n)
+        self.model_admin = InvitationAdmin(Invitation, admin.site)
+        self.request = RequestFactory().get('/admin/invitation/invitation/')
+        self.request.user = self.admin_user
+        self.request.session = {}
+        self.request._messages = default_storage(self.request)
+
+    def show_changelist(self):
+        model_admin = self.model_admin
+        cl = ChangeList(self.request, Invitation, model_admin.list_display,
+                        model_admin.list_display_links, model_admin.list_filter,
+                        model_admin.date_hierarchy, model_admin.search_fields,
+                        model_admin.list_select_related, model_admin.list_per_page,
+                        model_admin.list_max_show_all, model_admin.list_editable, model_admin)
+        return [[lookup_field(name, obj, model_admin)[2] for name in cl.list_display]
+                for obj in cl.result_list]
+
+    def test_changelist_queries(self):
+        """
+        Test that the number of queries made by the changelist does not
+        depend on the number of rows shown.
+
+        """
+        self.model_admin.list_per_page = 2
+        small = count_queries(self.show_changelist)
+        self.model_admin.list_per_page = 12
+        self.assertEqual(count_queries(self.show_changelist), small)
+        rows = self.show_changelist()
+        self.assertEqual(len(rows), 12)
+        self.assertEqual(sorted(row[-1] for row in rows), [False] * 11 + [True])
+
+    def test_bulk_actions(self):
+        """
+        Test that the admin actions update any number of invitations with
+        a fixed number of queries.
+
+        """
+        queryset = Invitation.objects.all()
+        with self.assertNumQueries(1):
+            self.model_admin.expire_invitations(self.request, queryset)
+        self.failUnless(all(invite.expired() for invite in Invitation.objects.all()))
+        with self.assertNumQueries(1):
+            self.model_admin.extend_invitations(self.request, queryset)
+        self.failIf(any(invite.expired() for invite in Invitation.objects.all()))
+        self.model_admin.resend_invitations(self.request, queryset)
+        self.assertEqual(len(mail.outbox), 12)
+
+
+class InvitationExportTests(InvitationTestCase):
+    """
+    Tests for the invitation export and statistics.
+
+    """
+    def test_export_command(self):
+        """
+        Test that ``manage.py exportinvitations`` writes every invitation,
+        whatever the batch size.
+
+        """
+        out = StringIO()
+        management.call_command('exportinvitations', batch_size=1, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], ','.join(export.EXPORT_FIELDS))
+        self.assertEqual(len(lines), 3)
+
+        out = StringIO()
+        management.call_command('exportinvitations', format='jsonl', stdout=out)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(dict((row['email'], row['status']) for row in rows),
+                         {'fred@example.com': models.STATUS_PENDING,
+                          'bob@example.com': models.STATUS_EXPIRED})
+
+    def test_stats(self):
+        """
+        Test that statistics take one query per dimension.
+
+        """
+        Invitation.objects.claim_invitation(self.sample_invite.code)
+        with self.assertNumQueries(1):
+            stats = export.invitation_stats('status')
+        self.assertEqual(stats, [{'status': models.STATUS_EXPIRED, 'count': 1},
+                                 {'status': models.STATUS_USED, 'count': 1}])
+        with self.assertNumQueries(1):
+            stats = export.invitation_stats('inviter')
+        self.assertEqual(stats, [{'inviter': 'alice', 'sent': 2, models.STATUS_PENDING: 0,
+                                  models.STATUS_EXPIRED: 1, models.STATUS_USED: 1}])
+        with self.assertNumQueries(1):
+            self.assertEqual(export.invitation_stats('day')[0]['sent'], 2)
+
+    def test_export_view(self):
+        """
+        Test that only staff can download the export.
+
+        """
+        url = reverse('invitation_export')
+        self.client.login(username='alice', password='secret')
+        response = self.client.get(url)
+        self.assertTemplateUsed(response, 'admin/login.html')
+        self.failIf(response.get('Content-Type') == 'text/csv')
+
+        User.objects.filter(username='alice').update(is_staff=True)
+        response = self.client.get(url, {'stats': 'inviter'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(''.join(response.streaming_content).splitlines(),
+                         ['inviter,sent,pending,expired,used', 'alice,2,1,1,0'])
+        self.assertEqual(self.client.get(url, {'format': 'xml'}).status_code, 404)
+
+
+@override_settings(INVITATION_INSTRUMENTATION=True,
+                   INVITATION_INSTRUMENTATION_SINKS=('invitation.instrumentation.MemorySink',),
+                   INVITATION_QUERY_BUDGETS={'invite': 10, 'invitation_accepted': 20})
+class InvitationInstrumentationTests(InvitationTestCase):
+    """
+    Tests for the view instrumentation and query budgets.
+
+    """
+    def setUp(self):
+        super(InvitationInstrumentationTests, self).setUp()
+        MemorySink.clear()
+
+    def assertWithinBudget(self, measurement):
+        self.failIf(measurement.over_budget, "%s made %d queries, over its budget of %d" % (
+            measurement.view, measurement.queries, measurement.budget))
+
+    def test_invite_budget(self):
+        """
+        Test that sending an invitation is measured stage by stage and
+        stays within its query budget.
+
+        """
+        self.client.login(username='alice', password='secret')
+        self.client.post(reverse('invitation_invite'), data={'email': 'carol@example.com'})
+        measurement = MemorySink.measurements[-1]
+        self.assertEqual(measurement.view, 'invite')
+        stages = measurement.stage_durations()
+        for name in ('form', 'create', 'code', 'send', 'render_email', 'smtp'):
+            self.failUnless(name in stages, name)
+        self.failUnless(measurement.queries > 0)
+        self.assertWithinBudget(measurement)
+
+    def test_accept_budget(self):
+        """
+        Test that accepting an invitation stays within its query budget.
+
+        """
+        self.client.post(reverse('invitation_accepted',
+                                 kwargs={'invitation_code': self.sample_invite.code}),
+                         data={'username': 'fred', 'password1': 'secret', 'password2': 'secret'})
+        measurement = MemorySink.measurements[-1]
+        self.assertEqual(measurement.view, 'invitation_accepted')
+        for name in ('lookup', 'form', 'claim', 'create_user', 'login'):
+            self.failUnless(name in measurement.stage_durations(), name)
+        self.assertWithinBudget(measurement)
+
+    def test_over_budget(self):
+        """
+        Test that a request making more queries than its budget is flagged.
+
+        """
+        with self.settings(INVITATION_QUERY_BUDGETS={'invitation_accepted': 0}):
+            self.client.get(reverse('invitation_accepted',
+                                    kwargs={'invitation_code': self.sample_invite.code}))
+        self.failUnless(MemorySink.measurements[-1].over_budget)
+
+    @skipUnless('replica' in settings.DATABASES, "needs a second database named 'replica'")
+    def test_all_connections(self):
+        """
+        Test that queries on other databases than the default one are
+        counted too.
+
+        """
+        @instrumented('replica_view')
+        def view(request):
+            Invitation.objects.using('default').count()
+            Invitation.objects.using('replica').count()
+            return HttpResponse()
+        view(RequestFactory().get('/'))
+        self.assertEqual(MemorySink.measurements[-1].queries, 2)
+
+
 class InvitationLimitTests(InvitationTestCase):
     def setUp(self):
         super(InvitationLimitTests, self).setUp()
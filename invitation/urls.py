@@ -1,7 +1,7 @@
 from django.conf.urls.defaults import *
 from django.views.generic import ListView, TemplateView
 
-from invitation.views import invite, invitation_accepted
+from invitation.views import invite, invitation_accepted, export_invitations
 
 urlpatterns = patterns('',
     url(r'^invite/complete/$',
@@ -11,7 +11,10 @@ urlpatterns = patterns('',
     url(r'^invite/$',
         invite,
         name='invitation_invite'),
-    url(r'^invite/(?P<invitation_code>\w+)/$',
+    url(r'^invite/export/$',
+        export_invitations,
+        name='invitation_export'),
+    url(r'^invite/(?P<invitation_code>[\w-]+)/$',
         invitation_accepted,
         name='invitation_accepted'),
 )
@@ -0,0 +1,15 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+
+def import_from_setting(path, what):
+    """
+    Import and return the object named by the dotted ``path`` taken from a
+    setting. ``what`` describes the object in the ``ImproperlyConfigured``
+    raised when it cannot be imported.
+    """
+    module_name, dot, attr = path.rpartition('.')
+    try:
+        return getattr(import_module(module_name), attr)
+    except (ImportError, AttributeError) as e:
+        raise ImproperlyConfigured("Error importing %s %s: %s" % (what, path, e))
@@ -1,27 +1,52 @@
 import datetime
+import math
 
 from django.conf import settings
-from django.contrib.auth import authenticate, login
+from django.contrib.auth import login, load_backend
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import UserCreationForm
 from django.core.urlresolvers import reverse
 from django.db import transaction
-from django.http import HttpResponseRedirect
+from django.http import Http404, HttpResponseRedirect, StreamingHttpResponse
 from django.utils.translation import ugettext_lazy as _
 from django.views.generic import ListView
 from django.shortcuts import render
 
-from invitation.models import Invitation
+from invitation.export import (csv_lines, jsonl_lines, iter_invitations, invitation_stats,
+                               stats_fields, EXPORT_FIELDS, FORMATS, STATS_DIMENSIONS)
+from invitation.instrumentation import instrumented, stage
 from invitation.forms import InvitationForm
+from invitation.ratelimit import get_rate_limiter
+from invitation.stores import get_store
 
+MODEL_BACKEND = 'django.contrib.auth.backends.ModelBackend'
+
+
+def _login_backend():
+    """
+    Return the path of the first of ``AUTHENTICATION_BACKENDS`` which
+    checks passwords against the ``User`` table, i.e. ``ModelBackend`` or a
+    subclass of it. A user who has just been created by their password can
+    only be logged in again by such a backend.
+    """
+    for path in settings.AUTHENTICATION_BACKENDS:
+        if isinstance(load_backend(path), ModelBackend):
+            return path
+    return MODEL_BACKEND
+
+@instrumented('invite')
 @login_required
 def invite(request, success_url=None, form_class=InvitationForm,
            template_name='invitation/invitation_form.html',):
     context = {}
+    store = get_store()
     if request.user.is_staff:
         context['remaining_invitations'] = 10
     elif hasattr(settings, 'INVITATIONS_PER_USER'):
-        remaining_invitations = Invitation.objects.remaining_invitations_for_user(request.user)
+        with stage('quota'):
+            remaining_invitations = store.remaining_invitations(request.user)
         if not remaining_invitations:
             error_msg = _("You do not have any remaining invitations.")
             return render(request, 'invitation/invalid.html', {'error_msg': error_msg})
@@ -29,11 +54,25 @@ def invite(request, success_url=None, form_class=InvitationForm,
             context['remaining_invitations'] = remaining_invitations
 
     if request.method == 'POST':
+        rate_limiter = get_rate_limiter()
+        if rate_limiter is not None:
+            with stage('ratelimit'):
+                wait = rate_limiter.throttle(request)
+            if wait:
+                error_msg = _("You are sending invitations too quickly. Please try again later.")
+                response = render(request, 'invitation/invalid.html', {'error_msg': error_msg},
+                                  status=429)
+                response['Retry-After'] = int(math.ceil(wait))
+                return response
         form = form_class(data=request.POST)
-        if form.is_valid():
+        with stage('form'):
+            is_valid = form.is_valid()
+        if is_valid:
             email = form.cleaned_data["email"]
-            invitation = Invitation.objects.create_invitation(request.user, email)
-            invitation.send()
+            with stage('create'):
+                invitation = store.create(request.user, email)
+            with stage('send'):
+                invitation.send()
             # success_url needs to be dynamically generated here; setting a
             # a default value using reverse() will cause circular-import
             # problems with the default URLConf for this application, which
@@ -42,36 +81,82 @@ def invite(request, success_url=None, form_class=InvitationForm,
     else:
         form = form_class()
     context['form'] = form
-    return render(request, template_name, context)
+    with stage('render'):
+        return render(request, template_name, context)
 
+@instrumented('invitation_accepted')
 @transaction.commit_on_success
 def invitation_accepted(request, invitation_code, success_url=settings.LOGIN_REDIRECT_URL,
                       form_class=UserCreationForm, template_name='invitation/accepted.html'):
     error_msg = None
-    try:
-        invitation = Invitation.objects.get(code=invitation_code)
-        if invitation.expired():
-            error_msg = _("This invitation has expired.")
-    except Invitation.DoesNotExist:
+    store = get_store()
+    with stage('lookup'):
+        invitation = store.lookup(invitation_code)
+    if invitation is None:
         error_msg = _("The invitation code is not valid. Please check the link provided and try again.")
+    elif invitation.used:
+        error_msg = _("This invitation has already been used.")
+    elif invitation.expired():
+        error_msg = _("This invitation has expired.")
 
     if error_msg is not None:
         return render(request, 'invitation/invalid.html', {'error_msg': error_msg})
 
     if request.method == 'POST':
         form = form_class(request.POST)
-        if form.is_valid():
-            user = form.save(commit=False)
-            user.email = invitation.email
-            user.save()
-            invitation.used = True
-            invitation.to_user = user
-            invitation.save()
-            user = authenticate(username=user.username, password=form.cleaned_data["password1"])
-            login(request, user)
+        with stage('form'):
+            is_valid = form.is_valid()
+        if is_valid:
+            # Claim the invitation before creating the account, so that
+            # concurrent submissions cannot both redeem the same code.
+            with stage('claim'):
+                claimed = store.claim(invitation)
+            if not claimed:
+                error_msg = _("This invitation has already been used or has expired.")
+                return render(request, 'invitation/invalid.html', {'error_msg': error_msg})
+            try:
+                with stage('create_user'):
+                    user = form.save(commit=False)
+                    user.email = invitation.email
+                    user.save()
+                    store.accept(invitation, user)
+                with stage('login'):
+                    # The password was only just set, so skip authenticate(),
+                    # which would load the user again and re-hash the password.
+                    user.backend = _login_backend()
+                    login(request, user)
+            except Exception:
+                # The transaction is rolled back, but the store may have
+                # claimed the invitation outside of the database.
+                store.release(invitation)
+                raise
             return HttpResponseRedirect(success_url)
     else:
         form = form_class()
-    return render(request, template_name,
-                              {'form': form,
-                               'invitation': invitation})
+    with stage('render'):
+        return render(request, template_name,
+                                  {'form': form,
+                                   'invitation': invitation})
+
+@staff_member_required
+def export_invitations(request):
+    """
+    Stream every invitation, or with ``?stats=<dimension>`` the counts by
+    status, inviter or day, as CSV or (with ``?format=jsonl``) JSON lines.
+    """
+    format = request.GET.get('format', 'csv')
+    dimension = request.GET.get('stats')
+    if format not in FORMATS or (dimension is not None and dimension not in STATS_DIMENSIONS):
+        raise Http404
+    if dimension is not None:
+        rows, fields = invitation_stats(dimension), stats_fields(dimension)
+        filename = 'invitation-stats-%s' % dimension
+    else:
+        rows, fields = iter_invitations(), EXPORT_FIELDS
+        filename = 'invitations'
+    if format == 'csv':
+        response = StreamingHttpResponse(csv_lines(rows, fields), content_type='text/csv')
+    else:
+        response = StreamingHttpResponse(jsonl_lines(rows), content_type='application/x-ndjson')
+    response['Content-Disposition'] = 'attachment; filename=%s.%s' % (filename, format)
+    return response
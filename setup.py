@@ -8,6 +8,7 @@ setup(
     author_email='lungofish@gmail.com',
     url='https://github.com/joeatmatterport/django-invitation-simplified',
     packages=find_packages(),
+    install_requires=['South>=0.7'],
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',